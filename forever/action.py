@@ -9,9 +9,10 @@ import numpy
 from numpy import zeros, multiply, float32, mean, copy
 
 from echonest.audio import assemble
-from cAction import limit, crossfade, fadein, fadeout, fade
+from cAction import limit
 from itertools import izip
 import logging
+import mixing
 
 import dirac
 
@@ -43,6 +44,23 @@ def make_stereo(track):
     return track
 
 
+def reuse(out, like, size):
+    """An int16 buffer that `like` can be rendered into: out, if it fits."""
+    if out is None or len(out) < len(like) or out.shape[1:] != like.shape[1:]:
+        out = numpy.empty((max(size, len(like)),) + like.shape[1:],
+                          dtype=numpy.int16)
+    return out[:len(like)]
+
+
+def stretch_beat(d, rate, gain, quality=0, samplerate=44100):
+    """Time-stretches one beat of audio by rate, applying gain if given."""
+    if gain is not None:
+        return limit(multiply(dirac.timeScale(d, rate, samplerate, quality),
+                     float32(gain)))
+    else:
+        return dirac.timeScale(d, rate, samplerate, quality)
+
+
 def render(actions, filename, verbose=True):
     """Calls render on each action in actions, concatenates the results,
     renders an audio file, and returns a path to the file"""
@@ -52,6 +70,47 @@ def render(actions, filename, verbose=True):
     return out, out.encode(filename)
 
 
+class StagingBuffer(object):
+    """Fixed-capacity staging area that stretched audio is appended to in
+    place, and that hands out chunk_size pieces of it as views. Views are
+    only valid until the next call to append."""
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.data = None
+        self.head = 0   # first sample not yet handed out
+        self.tail = 0   # one past the last sample appended
+
+    def append(self, samples):
+        leftover = self.tail - self.head
+        needed = leftover + len(samples)
+        if self.data is None or needed > len(self.data):
+            #   Only happens when a single beat is longer than anything
+            #   we've seen before - the common case reuses the buffer.
+            data = numpy.empty((max(needed, 2 * self.chunk_size),)
+                               + samples.shape[1:], dtype=samples.dtype)
+            if leftover:
+                data[0:leftover] = self.data[self.head:self.tail]
+            self.data = data
+        elif leftover and self.head:
+            self.data[0:leftover] = self.data[self.head:self.tail]
+        self.data[leftover:needed] = samples
+        self.head, self.tail = 0, needed
+
+    def chunks(self):
+        """Yields every complete chunk currently buffered."""
+        while self.tail - self.head >= self.chunk_size:
+            self.head += self.chunk_size
+            yield self.data[self.head - self.chunk_size:self.head]
+
+    def rest(self):
+        """Returns (and consumes) whatever is left over."""
+        if self.data is None:
+            return None
+        rest = self.data[self.head:self.tail]
+        self.head = self.tail
+        return rest
+
+
 class Playback(object):
     """A snippet of the given track with start and duration. Volume leveling
     may be applied."""
@@ -68,14 +127,15 @@ class Playback(object):
 
     def render(self, chunk_size=None):
         gain = getattr(self.track, 'gain', None)
+        scratch, out = mixing.Scratch(), None
         if chunk_size is None:
             # self has start and duration, so it is a valid index into track.
             output = self.track[self].data
 
             # Normalize volume if necessary
             if gain is not None:
-                # limit expects a float32 vector
-                output = limit(multiply(output, float32(gain)))
+                output = mixing.gain(output, gain, reuse(None, output, 0),
+                                     scratch)
 
             yield output
         else:
@@ -85,13 +145,12 @@ class Playback(object):
             else:
                 start, end = self.start, self.end
             for i in xrange(start, end, chunk_size):
+                data = self.track[i:min(end, i + chunk_size)].data
                 if gain is not None:
-                    yield limit(multiply(
-                            self.track[i:min(end, i + chunk_size)].data,
-                            float32(gain)
-                          )).astype(numpy.int16)
+                    out = reuse(out, data, chunk_size)
+                    yield mixing.gain(data, gain, out, scratch)
                 else:
-                    yield self.track[i:min(end, i + chunk_size)].data
+                    yield data
 
     def __repr__(self):
         return "<Playback '%s'>" % self.track.analysis.pyechonest_track.title
@@ -109,17 +168,22 @@ class Playback(object):
 class Fadeout(Playback):
     def render(self, chunk_size=None):
         gain = getattr(self.track, 'gain', 1.0)
+        scratch, out = mixing.Scratch(), None
         if chunk_size is None:
-            yield fadeout(self.track[self].data, gain)
+            data = self.track[self].data
+            yield mixing.fade(data, gain, 1.0, 0.0, reuse(None, data, 0),
+                              scratch)
         else:
             start = int(self.start * 44100)
             end = int((self.start + self.duration) * 44100)
             for i in xrange(start, end, chunk_size):
                 e = min(end, i + chunk_size)
-                yield (fade(self.track[i:e].data, gain,
-                            1.0 - (float(i - start) / (end - start)),
-                            1.0 - (float(e - start) / (end - start)))
-                            .astype(numpy.int16))
+                data = self.track[i:e].data
+                out = reuse(out, data, chunk_size)
+                yield mixing.fade(data, gain,
+                                  1.0 - (float(i - start) / (end - start)),
+                                  1.0 - (float(e - start) / (end - start)),
+                                  out, scratch)
 
     def __repr__(self):
         return "<Fadeout '%s'>" % self.track.analysis.pyechonest_track.title
@@ -133,19 +197,22 @@ class Fadeout(Playback):
 class Fadein(Playback):
     def render(self, chunk_size=None):
         gain = getattr(self.track, 'gain', 1.0)
+        scratch, out = mixing.Scratch(), None
         if chunk_size is None:
-            output = self.track[self].data
-            output = fadein(output, gain)
-            yield output
+            data = self.track[self].data
+            yield mixing.fade(data, gain, 0.0, 1.0, reuse(None, data, 0),
+                              scratch)
         else:
             start = int(self.start * 44100)
             end = int((self.start + self.duration) * 44100)
             for i in xrange(start, end, chunk_size):
                 e = min(end, i + chunk_size)
-                yield (fade(self.track[i:e].data, gain,
-                            (float(i - start) / (end - start)),
-                            (float(e - start) / (end - start)))
-                            .astype(numpy.int16))
+                data = self.track[i:e].data
+                out = reuse(out, data, chunk_size)
+                yield mixing.fade(data, gain,
+                                  (float(i - start) / (end - start)),
+                                  (float(e - start) / (end - start)),
+                                  out, scratch)
 
     def __repr__(self):
         return "<Fadein '%s'>" % self.track.analysis.pyechonest_track.title
@@ -196,16 +263,21 @@ class Crossfade(object):
         #   For now, only support stereo tracks
         assert self.t1.track.data.ndim == 2
         assert self.t2.track.data.ndim == 2
+        scratch, out = mixing.Scratch(), None
         if chunk_size is None:
-            yield crossfade(self.t1.data, self.t2.data, self.mode)
+            d1, d2 = self.t1.get().data, self.t2.get().data
+            n = min(len(d1), len(d2))
+            yield mixing.crossfade(d1[:n], d2[:n], reuse(None, d1[:n], 0),
+                                   scratch, self.mode)
         else:
             start = int(self.s1 * 44100)
             end = int((self.s1 + self.duration) * 44100)
             for i in xrange(start, end, chunk_size):
                 e = min(end, i + chunk_size)
-                yield (crossfade(self.t1.track[i:e].data,
-                                 self.t2.track[i:e].data, self.mode,
-                                 self.samples, i - start).astype(numpy.int16))
+                d1, d2 = self.t1.track[i:e].data, self.t2.track[i:e].data
+                out = reuse(out, d1, chunk_size)
+                yield mixing.crossfade(d1, d2, out, scratch, self.mode,
+                                       self.samples, i - start)
 
     def __repr__(self):
         args = (self.t1.track.analysis.pyechonest_track.title, self.t2.track.analysis.pyechonest_track.title)
@@ -282,6 +354,10 @@ class Blend(object):
 class Crossmatch(Blend):
     quality = 0
 
+    #   If set (i.e.: to a stretcher.ParallelStretcher) beats are stretched
+    #   by this object rather than one at a time in this process.
+    stretcher = None
+
     """Makes a beat-matched crossfade between the two input tracks."""
     def calculate_durations(self):
         c, dec = 1.0, 1.0 / float(len(self.l1) + 1)
@@ -291,77 +367,53 @@ class Crossmatch(Blend):
             self.durations.append(c * d1 + (1 - c) * d2)
         self.duration = sum(self.durations)
 
-    @property
-    def samples(self):
-        if not hasattr(self, '__samples'):
-            durs = []
-            for l in [self.l1, self.l2]:
-                rates = []
-                o = 0
-                signal_start = int(l[0][0] * 44100)
-                for i in xrange(len(l)):
-                    rate = (int(l[i][0] * 44100) - signal_start,
-                            self.durations[i] / l[i][1])
-                    rates.append(rate)
-                for (s1, r1), (s2, r2) in zip(rates, rates[1:]):
-                    o += int((s2 - s1) * r1)
-                end = int((sum(l[-1]) - l[0][0]) * 44100)
-                o += int((end - rates[-1][0]) * rates[-1][1])
-                durs += [o]
-            self.__samples = min(durs)
-        return self.__samples
+        #   Work out exactly which samples get stretched by how much, once.
+        self.plans = (self.plan(self.t1, self.l1), self.plan(self.t2, self.l2))
+        self.samples = min(sum(p[3] for p in plan) for plan in self.plans)
+
+    def plan(self, t, l):
+        """Returns a (start, end, rate, stretched length) tuple in samples
+        for each beat in l."""
+        sr = t.sampleRate
+        starts = [int(s * sr) for s, d in l]
+        ends = starts[1:] + [int(l[0][0] * sr)
+                             + int((sum(l[-1]) - l[0][0]) * sr)]
+        rates = [self.durations[i] / l[i][1] for i in xrange(len(l))]
+        return [(s, e, r, int((e - s) * r))
+                for s, e, r in zip(starts, ends, rates)]
 
     def g(self, d, gain, rate):
-        s = 44100
-        if gain is not None:
-            return limit(multiply(dirac.timeScale(d, rate, s, self.quality),
-                         float32(gain)))
-        else:
-            return dirac.timeScale(d, rate, s, self.quality)
+        return stretch_beat(d, rate, gain, self.quality)
 
     def stretch(self, t, l):
-        """t is a track, l is a list"""
+        """t is a track, l is a list. Returns an iterator over the stretched
+        beats, in order. With a stretcher set, every beat is dispatched as
+        soon as this is called."""
         gain = getattr(t, 'gain', None)
-        signal_start = int(l[0][0] * t.sampleRate)
-        rates = []
-        for i in xrange(len(l)):
-            rate = (int(l[i][0] * t.sampleRate) - signal_start,
-                    self.durations[i] / l[i][1])
-            rates.append(rate)
-
-        #   In case the for loop never runs due to too few elements.
-        e = int(rates[-1][0] + signal_start)
-
-        for i, ((s1, r1), (s2, r2)) in enumerate(izip(rates, rates[1:])):
-            s = int(s1 + signal_start)
-            e = int(s2 + signal_start)
-            yield self.g(t[s:e].data, gain, r1)
-
-        end = signal_start + int((sum(l[-1]) - l[0][0]) * t.sampleRate)
-        yield self.g(t[e:end].data, gain, r2)
-
-    def __buffered(self, t, l, c):
-        buf = None
-        for chunk in self.stretch(t, l):
-            if buf is not None:
-                chunk = numpy.append(buf, chunk, 0)
-                buf = None
-            if len(chunk) > c:
-                steps = range(0, len(chunk), c)
-                for s, e in izip(steps, steps[1:]):
-                    yield chunk[s:e]
-                buf = chunk[e:]
-            elif len(chunk) < c:
-                buf = chunk
-            else:
-                yield chunk
-        if buf is not None and len(buf):
-            yield buf
-
-    def __limited(self, t, l, c, limit=None):
+        if l is self.l1:
+            plan = self.plans[0]
+        elif l is self.l2:
+            plan = self.plans[1]
+        else:
+            plan = self.plan(t, l)
+        if self.stretcher is not None:
+            return self.stretcher.stretch(t, plan, gain, self.quality)
+        return (self.g(t[s:e].data, gain, rate) for s, e, rate, _ in plan)
+
+    def __buffered(self, stretched, c):
+        buf = StagingBuffer(c)
+        for chunk in stretched:
+            buf.append(chunk)
+            for piece in buf.chunks():
+                yield piece
+        rest = buf.rest()
+        if rest is not None and len(rest):
+            yield rest
+
+    def __limited(self, stretched, c, limit=None):
         if limit is None:
             limit = self.samples
-        for i, chunk in enumerate(self.__buffered(t, l, c)):
+        for i, chunk in enumerate(self.__buffered(stretched, c)):
             if (i * c) + len(chunk) > limit:
                 yield chunk[0:limit - (i * c)]
                 return
@@ -369,14 +421,20 @@ class Crossmatch(Blend):
                 yield chunk
 
     def render(self, chunk_size=None):
-        stretch1, stretch2 = self.__limited(self.t1, self.l1, chunk_size),\
-                             self.__limited(self.t2, self.l2, chunk_size)
+        """Yields int16 chunks. To avoid allocating on every chunk, each one
+        is a view into the same output buffer - consume it (or
+        mixing.keep it) before asking for the next."""
+        stretch1, stretch2 = \
+            self.__limited(self.stretch(self.t1, self.l1), chunk_size),\
+            self.__limited(self.stretch(self.t2, self.l2), chunk_size)
+        out = numpy.empty((chunk_size, 2), dtype=numpy.int16)
+        scratch = mixing.Scratch()
         total = 0
         for i, (a, b) in enumerate(izip(stretch1, stretch2)):
             o = min(len(a), len(b))
             total += o
-            yield crossfade(a[:o], b[:o], '', self.samples, i * chunk_size)\
-                    .astype(numpy.int16)
+            yield mixing.crossfade(a[:o], b[:o], out[:o], scratch, 'linear',
+                                   self.samples, i * chunk_size)
 
         leftover = self.samples - total
         if leftover > 0:
@@ -0,0 +1,90 @@
+"""
+analysiscache.py
+
+On-disk cache of track analyses, keyed by the MD5 of the audio file.
+Analyses are stored as compressed CompactAnalysis files, named with the
+format version so that stale files are simply never read again. The
+cache is bounded in size; the least recently used files go first.
+"""
+
+import os
+import errno
+import config
+import logging
+import tempfile
+import traceback
+from compactanalysis import CompactAnalysis, VERSION
+
+log = logging.getLogger(__name__)
+
+
+class AnalysisCache(object):
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @classmethod
+    def from_config(cls):
+        return cls(config.analysis_cache_dir,
+                   config.analysis_cache_size * 1024 * 1024)
+
+    def path(self, md5):
+        return os.path.join(self.directory, "%s.v%d.npz" % (md5, VERSION))
+
+    def get(self, md5):
+        """Return the cached CompactAnalysis for `md5`, or None."""
+        path = self.path(md5)
+        if not os.path.isfile(path):
+            return None
+        try:
+            analysis = CompactAnalysis.load(path)
+        except Exception:
+            log.warning("Removing unreadable cached analysis %s:\n%s",
+                        path, traceback.format_exc())
+            self.remove(path)
+            return None
+        #   Bump the mtime - this is what our LRU eviction goes by.
+        os.utime(path, None)
+        return analysis
+
+    def put(self, md5, analysis):
+        if not isinstance(analysis, CompactAnalysis):
+            analysis = CompactAnalysis.from_analysis(analysis)
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                analysis.save(f)
+            os.rename(tmp, self.path(md5))
+        except Exception:
+            self.remove(tmp)
+            raise
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Delete the least recently used analyses until we fit in max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            log.info("Evicting cached analysis %s.", path)
+            self.remove(path)
+            total -= size
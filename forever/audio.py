@@ -10,10 +10,16 @@ import os
 import hashlib
 import sys
 import logging
+import traceback
 import subprocess
 import uuid
 import gc
 import weakref
+import threading
+import config
+import localanalyzer
+from pcmbuffer import PCMBuffer
+from analysiscache import AnalysisCache
 from exceptionthread import ExceptionThread
 from monkeypatch import monkeypatch_class
 
@@ -22,6 +28,24 @@ from echonest.audio import AudioAnalysis, AudioData, LocalAudioFile, AudioQuantu
 from echonest.support.ffmpeg import ffmpeg
 
 FFMPEG_ERROR_TIMEOUT = 0.2
+FFMPEG_STREAM_CHUNK = 44100 / 4     # samples per read from ffmpeg's stdout
+INITIAL_STREAM_BUFFER = 30          # seconds of audio to preallocate
+
+_reads = threading.local()
+
+
+class preserving(object):
+    """
+    Within this context, slicing an AudioData from the current thread never
+    throws away the audio before the slice - i.e.: when rendering ahead of
+    another thread that is still reading earlier parts of the same track.
+    """
+    def __enter__(self):
+        _reads.preserve = True
+        return self
+
+    def __exit__(self, *args):
+        _reads.preserve = False
 
 
 class AudioData(AudioData):
@@ -38,7 +62,8 @@ class AudioData(AudioData):
                 filedata=None,
                 rawfiletype='wav',
                 uid=None,
-                pcmFormat=numpy.int16):
+                pcmFormat=numpy.int16,
+                stream=False):
         self.verbose = verbose
         if (filename is not None) and (ndarray is None):
             if sampleRate is None or numChannels is None:
@@ -54,6 +79,9 @@ class AudioData(AudioData):
         self.convertedfile = None
         self.endindex = 0
         self.uid = uid
+        self.streaming = stream
+        self.pcm = None
+        self.__decoder = None
         if shape is None and isinstance(ndarray, numpy.ndarray) and not self.defer:
             self.data = numpy.zeros(ndarray.shape, dtype=numpy.int16)
         elif shape is not None and not self.defer:
@@ -71,6 +99,8 @@ class AudioData(AudioData):
             self.data[0:self.endindex] = ndarray
         self.offset = 0
         self.read_destructively = True
+        #   Held while data and offset change together, or are read together.
+        self.lock = threading.RLock()
 
     def load(self, file_to_read=None, pcmFormat=numpy.int16):
         if isinstance(self.data, numpy.ndarray):
@@ -87,6 +117,8 @@ class AudioData(AudioData):
                 file_to_read = self.filedata
             elif self.convertedfile:
                 file_to_read = self.convertedfile
+            elif self.streaming:
+                return self.load_streaming(pcmFormat=pcmFormat)
             else:
                 self.numChannels = 2
                 self.sampleRate = 44100
@@ -124,6 +156,112 @@ class AudioData(AudioData):
             self.endindex = len(ndarray)
             self.data = ndarray
 
+    def load_streaming(self, pcmFormat=numpy.int16):
+        """
+        Kick off ffmpeg in the background and return immediately. Decoded
+        samples are appended to a growable PCMBuffer as they arrive, and
+        slicing blocks only until the requested range has been decoded.
+        """
+        self.numChannels = 2
+        self.sampleRate = 44100
+        self.pcm = PCMBuffer(INITIAL_STREAM_BUFFER * self.sampleRate,
+                             self.numChannels, pcmFormat)
+        self.data = self.pcm.data
+        self.endindex = 0
+
+        null = open(os.devnull, 'w')
+        if self.filename:
+            source, raw = self.filename, None
+        else:
+            self.filedata.seek(0)
+            source, raw = 'pipe:0', self.filedata.read()
+        proc = subprocess.Popen(
+            ['ffmpeg', '-i', source, '-f', 's16le', '-acodec', 'pcm_s16le',
+             '-ac', str(self.numChannels), '-ar', str(self.sampleRate), '-'],
+            stdin=subprocess.PIPE if raw is not None else null,
+            stdout=subprocess.PIPE,
+            stderr=null
+        )
+        self.__decoder = proc
+        if raw is not None:
+            feeder = threading.Thread(target=self.__feed_ffmpeg,
+                                      args=(proc, raw))
+            feeder.setDaemon(True)
+            feeder.start()
+        reader = threading.Thread(target=self.__read_ffmpeg,
+                                  args=(proc, self.pcm))
+        reader.setDaemon(True)
+        reader.start()
+
+    def __feed_ffmpeg(self, proc, raw):
+        try:
+            proc.stdin.write(raw)
+        except IOError:
+            pass    # ffmpeg died - the reader will find out soon enough.
+        finally:
+            proc.stdin.close()
+
+    def __read_ffmpeg(self, proc, pcm):
+        frame = self.numChannels * (pcm.data.dtype.itemsize)
+        error = None
+        try:
+            while True:
+                raw = proc.stdout.read(FFMPEG_STREAM_CHUNK * frame)
+                usable = len(raw) - (len(raw) % frame)
+                if not usable:
+                    break
+                chunk = numpy.frombuffer(raw[:usable], dtype="<h")
+                pcm.write(chunk.reshape((-1, self.numChannels)))
+                with self.lock:
+                    if self.pcm is pcm:
+                        self.data = pcm.data
+                        self.endindex = pcm.end
+            if proc.wait() and not pcm.end:
+                error = IOError("ffmpeg exited with code %d for %s"
+                                % (proc.returncode, self.uid))
+        except Exception as e:
+            error = e
+        finally:
+            #   Hand over the buffer as it is: trimming it to size would
+            #   mean copying the whole track.
+            with self.lock:
+                if self.pcm is pcm:
+                    self.data = pcm.data
+            pcm.finish(error)
+            if error is not None and self.pcm is pcm:
+                logging.getLogger(__name__).error(
+                    "Streaming decode failed: %s", error)
+
+    def wait_for_audio(self):
+        """
+        Block until a streaming decode has produced some audio. Raises
+        ffmpeg's error if it failed before it got that far.
+        """
+        if not self.pcm.wait_for(1):
+            raise IOError("ffmpeg decoded no audio for %s" % self.uid)
+
+    def finish(self):
+        """
+        Let go of this track's audio, first stopping the streaming decode if
+        that's still running. Anything sliced from the track afterwards is
+        empty.
+        """
+        with self.lock:
+            pcm, self.pcm = self.pcm, None
+            if isinstance(self.data, numpy.ndarray):
+                self.data = numpy.zeros((0,) + self.data.shape[1:],
+                                        dtype=self.data.dtype)
+            self.endindex = 0
+        proc, self.__decoder = self.__decoder, None
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass    # it's just exited on its own
+        if pcm is not None:
+            #   Wake up anybody still waiting on audio that won't come.
+            pcm.finish()
+
     def encode_to_stringio(self):
         fid = cStringIO.StringIO()
         # Based on Scipy svn
@@ -229,24 +367,67 @@ class AudioData(AudioData):
         "Help `__getitem__` return a new AudioData for a given slice"
         if not isinstance(self.data, numpy.ndarray) and self.defer:
             self.load()
-        if isinstance(index.start, float):
-            index = slice(int(index.start * self.sampleRate) - self.offset,
-                            int(index.stop * self.sampleRate) - self.offset, index.step)
-        else:
-            index = slice(index.start - self.offset, index.stop - self.offset)
-        a = AudioData(None, self.data[index], sampleRate=self.sampleRate,
-                            numChannels=self.numChannels, defer=False)
-        if self.read_destructively:
-            self.remove_upto(index.start)
+        if self.pcm is not None:
+            return self.getslice_streaming(index)
+        with self.lock:
+            if isinstance(index.start, float):
+                index = slice(int(index.start * self.sampleRate) - self.offset,
+                                int(index.stop * self.sampleRate) - self.offset, index.step)
+            else:
+                index = slice(index.start - self.offset, index.stop - self.offset)
+            data = self.data[index]
+            if self.read_destructively and not getattr(_reads, 'preserve', False):
+                self.remove_upto(index.start)
+        return AudioData(None, data, sampleRate=self.sampleRate,
+                         numChannels=self.numChannels, defer=False)
+
+    def getslice_streaming(self, index):
+        """
+        Like `getslice`, but for a track that's still being decoded. Blocks
+        until every sample in the slice is available.
+        """
+        start, stop = index.start, index.stop
+        if isinstance(start, float):
+            start = int(start * self.sampleRate)
+        if isinstance(stop, float):
+            stop = int(stop * self.sampleRate)
+        if start is None:
+            start = self.offset
+        if stop is None:
+            stop = sys.maxint
+        a = AudioData(None, sampleRate=self.sampleRate,
+                      numChannels=self.numChannels, defer=True)
+        a.data = self.pcm.slice(start, stop)
+        a.endindex = len(a.data)
+        if self.read_destructively and not getattr(_reads, 'preserve', False):
+            with self.lock:
+                self.remove_upto(start - self.offset)
         return a
 
+    def getsample(self, index):
+        "Help `__getitem__` return a single frame (or a new AudioData)."
+        if self.pcm is not None and isinstance(index, int):
+            return self.pcm.sample(index)
+        if isinstance(index, int):
+            return self.data[index]
+        else:
+            return AudioData(None, self.data[index], defer=False)
+
     def remove_upto(self, sample):
         if isinstance(sample, float):
             sample = int(sample * self.sampleRate)
-        if sample:
+        with self.lock:
+            if self.pcm is not None:
+                if sample > 0:
+                    self.pcm.discard_upto(self.offset + sample)
+                    self.offset = self.pcm.start
+                    self.data = self.pcm.data
+                return
+            if not sample:
+                return
             self.data = numpy.delete(self.data, slice(0, sample), 0)
             self.offset += sample
-            gc.collect()
+        gc.collect()
 
 
 class LocalAudioFile(LocalAudioFile):
@@ -259,13 +440,21 @@ class LocalAudioFile(LocalAudioFile):
     """
     __metaclass__ = monkeypatch_class
 
-    def __init__(self, data, kind="mp3", uid=None, verbose=False):
+    def __init__(self, data, kind="mp3", uid=None, verbose=False, stream=None):
         if not uid:
             uid = str(uuid.uuid4()).replace('-', '')
+        if stream is None:
+            stream = config.get('stream_decode', False)
 
         #   Initializing the audio file could be slow. Let's do this in parallel.
-        AudioData.__init__(self, filedata=data, rawfiletype=type, verbose=verbose, defer=True, uid=uid)
-        loading = ExceptionThread(target=self.load)
+        AudioData.__init__(self, filedata=data, rawfiletype=kind, verbose=verbose, defer=True, uid=uid, stream=stream)
+        if self.streaming:
+            #   Streaming decodes run in the background on their own - all
+            #   we have to wait for is ffmpeg to get going (or to fail).
+            self.load()
+            loading = ExceptionThread(target=self.wait_for_audio)
+        else:
+            loading = ExceptionThread(target=self.load)
         loading.start()
 
         start = time.time()
@@ -277,17 +466,34 @@ class LocalAudioFile(LocalAudioFile):
             print >> sys.stderr, "Computed MD5 of file is " + track_md5
 
         logging.getLogger(__name__).info("Fetching analysis...")
-        try:
-            if verbose:
-                print >> sys.stderr, "Probing for existing analysis"
-            loading.join(FFMPEG_ERROR_TIMEOUT)
-            tempanalysis = AudioAnalysis(str(track_md5))
-        except Exception:
+        cache = AnalysisCache.from_config()
+        tempanalysis = cache.get(track_md5)
+        if tempanalysis is not None:
             if verbose:
-                print >> sys.stderr, "Analysis not found. Uploading..."
-            #   Let's fail faster - check and see if FFMPEG has errored yet, before asking EN
-            loading.join(FFMPEG_ERROR_TIMEOUT)
-            tempanalysis = AudioAnalysis(data, kind)
+                print >> sys.stderr, "Found cached analysis"
+        else:
+            if config.get('offline_analysis', False):
+                if verbose:
+                    print >> sys.stderr, "Analyzing locally"
+                loading.join()
+                tempanalysis = localanalyzer.analyze(self, track_md5)
+            else:
+                try:
+                    if verbose:
+                        print >> sys.stderr, "Probing for existing analysis"
+                    loading.join(FFMPEG_ERROR_TIMEOUT)
+                    tempanalysis = AudioAnalysis(str(track_md5))
+                except Exception:
+                    if verbose:
+                        print >> sys.stderr, "Analysis not found. Uploading..."
+                    #   Let's fail faster - check and see if FFMPEG has errored yet, before asking EN
+                    loading.join(FFMPEG_ERROR_TIMEOUT)
+                    tempanalysis = AudioAnalysis(data, kind)
+            try:
+                cache.put(track_md5, tempanalysis)
+            except Exception:
+                logging.getLogger(__name__).warning(
+                    "Could not cache analysis:\n%s", traceback.format_exc())
 
         logging.getLogger(__name__).info("Fetched analysis in %ss",
                                          (time.time() - start))
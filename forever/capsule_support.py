@@ -7,10 +7,11 @@ capsule_support.py
 Created by Tristan Jehan and Jason Sundram.
 """
 
+import logging
 import numpy as np
-from copy import deepcopy
+from numpy.lib.stride_tricks import as_strided
 from action import Crossfade, Playback, Crossmatch, Fadein, Fadeout, humanize_time
-from utils import rows, flatten
+from utils import rows
 
 # constants for now
 X_FADE = 3
@@ -22,6 +23,7 @@ MIN_ALIGN_DURATION = 3
 LOUDNESS_THRESH = -8
 FUSION_INTERVAL = .06    # this is what we use in the analyzer
 AVG_PEAK_OFFSET = 0.025  # Estimated time between onset and peak of segment.
+DIST_TOLERANCE = 1e-4    # relative slack when re-checking near-best windows
 
 
 def display_actions():
@@ -38,30 +40,73 @@ def evaluate_distance(mat1, mat2):
     return np.linalg.norm(mat1.flatten() - mat2.flatten())
 
 
-def upsample_matrix(m):
-    """ Upsample matrices by a factor of 2."""
-    r, c = m.shape
-    out = np.zeros((2 * r, c), dtype=np.float32)
-    for i in xrange(r):
-        out[i * 2    , :] = m[i, :]
-        out[i * 2 + 1, :] = m[i, :]
-    return out
+def window_distances(mats, search, count=None):
+    """ Distances between each of mats and each of the first `count` windows
+        of rows(mat) consecutive rows in search, computed in one batch.
+        Takes one matrix (giving a vector of distances) or a stack of
+        equally-sized ones (giving one row of distances for each).
+    """
+    single = mats.ndim == 2
+    if single:
+        mats = mats[np.newaxis]
+    k, n, c = mats.shape
+    if count is None:
+        count = rows(search) - n + 1
+    if count <= 0:
+        distances = np.zeros((k, 0))
+    else:
+        search = np.ascontiguousarray(search[:count + n - 1])
+        windows = as_strided(search, shape=(count, n, c),
+                             strides=(search.strides[0],) + search.strides)
+        diff = (windows[np.newaxis] - mats[:, np.newaxis])\
+            .reshape(k, count, -1).astype(np.float64)
+        distances = np.sqrt(np.einsum('kij,kij->ki', diff, diff))
+    return distances[0] if single else distances
+
+
+def best_windows(mats, search, count):
+    """ Find the (matrix, offset) pair - among a stack of matrices and the
+        first `count` windows of search - with the smallest distance. Ties
+        go to the earliest matrix, then the earliest offset, exactly as a
+        min() over evaluate_distance would pick them.
+        Returns (matrix index, offset, distance).
+    """
+    n = mats.shape[1]
 
+    def dist(pair):
+        return evaluate_distance(mats[pair[0]], search[pair[1]:pair[1] + n, :])
 
-def upsample_list(l, rate=2):
-    """ Upsample lists by a factor of 2."""
-    if rate != 2:
-        return l[:]
-    # Assume we're an AudioQuantumList.
+    distances = window_distances(mats, search, count)
+    if not distances.size or np.isnan(distances).any():
+        pairs = [(k, i) for k in xrange(len(mats)) for i in xrange(count)]
+    else:
+        # The batch is summed differently (and more precisely) than
+        # evaluate_distance, so re-score anything within rounding of the best.
+        best = distances.min()
+        pairs = zip(*np.nonzero(distances <= best * (1 + DIST_TOLERANCE)))
+    k, i = min(pairs, key=dist)
+    return int(k), int(i), dist((k, i))
 
-    def split(x):
-        a = deepcopy(x)
-        a.duration = x.duration / 2
-        b = deepcopy(a)
-        b.start = x.start + a.duration
-        return a, b
 
-    return flatten(map(split, l))
+def upsample_matrix(m, axis=0):
+    """ Upsample matrices by a factor of 2."""
+    return np.repeat(m, 2, axis=axis).astype(np.float32)
+
+
+def upsample_spans(l, rate, start, n):
+    """ (start, duration) of l[start:start + n], as if l had been upsampled
+        by a factor of rate (2 splits each member in half; anything else
+        leaves l alone). Only the members that are needed get looked at.
+    """
+    if rate != 2:
+        return [(m.start, m.duration) for m in l[start:start + n]]
+    end = min(start + n, 2 * len(l))
+    spans = []
+    for i in xrange(start, end):
+        m = l[i // 2]
+        duration = m.duration / 2
+        spans.append((m.start + duration if i & 1 else m.start, duration))
+    return spans
 
 
 def average_duration(l):
@@ -72,8 +117,19 @@ def align(track1, track2, mat1, mat2):
     """ Constrained search between a settled section and a new section.
         Outputs location in mat2 and the number of rows used in the transition.
     """
+    _, min_loc, rows1, rate1, rate2, _ = align_candidates(track1, track2,
+                                                          mat1[np.newaxis], mat2)
+    return min_loc, rows1, rate1, rate2
+
+
+def align_candidates(track1, track2, mats1, mat2):
+    """ Like align, but searches for the best of several equally-sized
+        candidate matrices for track1 at once.
+        Outputs the index of the chosen candidate, location in mat2, the number
+        of rows used in the transition, both rates and the distance found.
+    """
     # Get the average marker duration.
-    marker1 = average_duration(getattr(track1.analysis, track1.resampled['rate'])[track1.resampled['index']:track1.resampled['index'] + rows(mat1)])
+    marker1 = average_duration(getattr(track1.analysis, track1.resampled['rate'])[track1.resampled['index']:track1.resampled['index'] + mats1.shape[1]])
     marker2 = average_duration(getattr(track2.analysis, track2.resampled['rate'])[track2.resampled['index']:track2.resampled['index'] + rows(mat2)])
 
     def get_adjustment(tr1, tr2):
@@ -88,25 +144,22 @@ def align(track1, track2, mat1, mat2):
 
     rate1, rate2 = get_adjustment(marker1, marker2)
     if rate1 == 2:
-        mat1 = upsample_matrix(mat1)
+        mats1 = upsample_matrix(mats1, axis=1)
     if rate2 == 2:
         mat2 = upsample_matrix(mat2)
 
     # Update sizes.
     rows2 = rows(mat2)
-    rows1 = min(rows(mat1), max(rows2 - MIN_SEARCH, MIN_MARKERS))  # at least the best of MIN_SEARCH choices
+    rows1 = min(mats1.shape[1], max(rows2 - MIN_SEARCH, MIN_MARKERS))  # at least the best of MIN_SEARCH choices
 
     # Search for minimum.
-    def dist(i):
-        return evaluate_distance(mat1[0:rows1, :], mat2[i:i + rows1, :])
-
-    min_loc = min(xrange(rows2 - rows1), key=dist)
+    k, min_loc, score = best_windows(mats1[:, 0:rows1, :], mat2, rows2 - rows1)
 
     # Let's make sure track2 ends its transition on a regular tatum.
     if rate2 == 2 and (min_loc + rows1) & 1:
         rows1 -= 1
 
-    return min_loc, rows1, rate1, rate2
+    return k, min_loc, rows1, rate1, rate2, score
 
 
 def equalize_tracks(tracks):
@@ -147,31 +200,65 @@ def is_valid(track, transition):
     return 2 * transition < dur
 
 
-def get_central(analysis, member='segments'):
-    """ Returns a tuple:
-        1) copy of the members (e.g. segments) between end_of_fade_in and start_of_fade_out.
-        2) the index of the first retained member.
+def spans_of(members):
+    """ A (len x 2) array of the (start, duration) of each member. """
+    if hasattr(members, 'spans'):   # CompactAnalysis
+        return members.spans
+    return np.array([(m.start, m.duration) for m in members],
+                    dtype=np.float64).reshape(-1, 2)
+
+
+def analysis_arrays(analysis, rate='tatums', feature='timbre'):
+    """
+    Pull out only what resample_arrays needs from an analysis object, as
+    plain numpy arrays that are cheap to pickle and send to another process.
     """
-    def central(s):
-        return analysis.end_of_fade_in <= s.start and (s.start + s.duration) < analysis.start_of_fade_out
+    if hasattr(analysis.segments, 'column'):
+        features = analysis.segments.column(feature)
+    else:
+        features = np.array([getattr(s, feature) for s in analysis.segments],
+                            dtype=np.float64).reshape(-1, 12)
+
+    return {
+        'segments': spans_of(analysis.segments),
+        'features': features,
+        'markers': spans_of(getattr(analysis, rate)),
+        'end_of_fade_in': analysis.end_of_fade_in,
+        'start_of_fade_out': analysis.start_of_fade_out,
+    }
+
+
+def central_indices(arrays, member='segments'):
+    """ Indices of the rows of arrays[member] between end_of_fade_in and start_of_fade_out."""
+    spans = arrays[member]
+    return np.nonzero((arrays['end_of_fade_in'] <= spans[:, 0]) &
+                      (spans[:, 0] + spans[:, 1] < arrays['start_of_fade_out']))[0]
 
-    members = getattr(analysis, member)  # this is nicer than data.__dict__[member]
-    ret = filter(central, members[:])
-    index = members.index(ret[0]) if ret else 0
 
-    return ret, index
+def get_central_spans(arrays, member='segments'):
+    """ Returns a tuple:
+        1) the (start, duration) rows between end_of_fade_in and start_of_fade_out.
+        2) the index of the first retained row.
+    """
+    central = central_indices(arrays, member)
+    index = int(central[0]) if len(central) else 0
+    return arrays[member][central], index
 
 
-def get_mean_offset(segments, markers):
-    if segments == markers:
+def get_mean_span_offset(segments, markers):
+    """ Mean distance between the starts of markers and of the segments
+        within FUSION_INTERVAL of them, or AVG_PEAK_OFFSET if there are none.
+        Both are (start, duration) arrays.
+    """
+    if segments.shape == markers.shape and np.array_equal(segments, markers):
         return 0
 
     index = 0
     offsets = []
     try:
-        for marker in markers:
-            while segments[index].start < marker.start + FUSION_INTERVAL:
-                offset = abs(marker.start - segments[index].start)
+        for marker_start in markers[:, 0]:
+            while segments[index, 0] < marker_start + FUSION_INTERVAL:
+                offset = abs(marker_start - segments[index, 0])
                 if offset < FUSION_INTERVAL:
                     offsets.append(offset)
                 index += 1
@@ -181,56 +268,134 @@ def get_mean_offset(segments, markers):
     return np.average(offsets) if offsets else AVG_PEAK_OFFSET
 
 
-def resample_features(data, rate='tatums', feature='timbre'):
+def resample_arrays(arrays, rate='tatums'):
     """
     Resample segment features to a given rate within fade boundaries.
-    @param data: analysis object.
+    @param arrays: output of analysis_arrays for the same rate and feature.
     @param rate: one of the following: segments, tatums, beats, bars.
-    @param feature: either timbre or pitch.
     @return A dictionary including a numpy matrix of size len(rate) x 12, a rate, and an index
     """
     ret = {'rate': rate, 'index': 0, 'cursor': 0, 'matrix': np.zeros((1, 12), dtype=np.float32)}
-    segments, ind = get_central(data.analysis, 'segments')
-    markers, ret['index'] = get_central(data.analysis, rate)
+    central = central_indices(arrays, 'segments')
+    segments, features = arrays['segments'][central], arrays['features'][central]
+    if rate == 'segments':
+        markers, ret['index'] = segments, int(central[0]) if len(central) else 0
+    else:
+        markers, ret['index'] = get_central_spans(arrays, 'markers')
 
     if len(segments) < 2 or len(markers) < 2:
         return ret
 
-    # Find the optimal attack offset
-    meanOffset = get_mean_offset(segments, markers)
-    tmp_markers = deepcopy(markers)
-
-    # Apply the offset
-    for m in tmp_markers:
-        m.start -= meanOffset
-        if m.start < 0:
-            m.start = 0
+    # Find the optimal attack offset, and apply it
+    starts = np.maximum(markers[:, 0] - get_mean_span_offset(segments, markers), 0)
+    durations = markers[:, 1]
 
     # Allocate output matrix, give it alias mat for convenience.
-    mat = ret['matrix'] = np.zeros((len(tmp_markers) - 1, 12), dtype=np.float32)
+    mat = ret['matrix'] = np.zeros((len(markers) - 1, 12), dtype=np.float32)
 
     # Find the index of the segment that corresponds to the first marker
-    f = lambda x: tmp_markers[0].start < x.start + x.duration
-    index = (i for i, x in enumerate(segments) if f(x)).next()
+    index = int(np.nonzero(starts[0] < segments[:, 0] + segments[:, 1])[0][0])
 
     # Do the resampling
+    if not spread_features(mat, segments, features, starts, durations, index):
+        spread_features_serial(mat, segments, features, starts, durations, index)
+
+    return ret
+
+
+def spread_features(mat, segments, features, starts, durations, index):
+    """
+    Add each segment's features to the rows of mat for the markers it
+    overlaps, weighted by overlap, all at once. Gives exactly the same
+    matrix as spread_features_serial - additions to each row even happen
+    in the same order - but only works if segment ends are sorted.
+    Returns False (without touching mat) if they aren't.
+    """
+    seg_starts, seg_ends = segments[:, 0], segments[:, 0] + segments[:, 1]
+    ends = starts + durations
+    if not (np.isfinite(seg_ends).all() and np.isfinite(ends).all()
+            and (np.diff(seg_ends) >= 0).all()):
+        return False
+
+    # Only markers with a row in mat get anything.
+    n, count = rows(mat), len(segments)
+    starts, durations, ends = starts[:n], durations[:n], ends[:n]
+
+    # Marker i takes every segment in [first[i], stop[i]) in full (less any
+    # part before the marker), then part of segment stop[i]. The serial
+    # version stops dead at the first marker that runs off the segments.
+    stop = np.maximum(np.maximum.accumulate(
+        np.searchsorted(seg_ends, ends, 'left')), index)
+    first = np.concatenate(([index], stop[:-1]))
+    overrun = np.nonzero(stop >= count)[0]
+    last = overrun[0] + 1 if len(overrun) else n
+
+    counts = (stop - first)[:last]
+    marker = np.repeat(np.arange(last), counts)
+    rank = np.arange(len(marker)) - np.repeat(np.cumsum(counts) - counts, counts)
+    segment = first[marker] + rank
+
+    m_start, m_duration = starts[marker], durations[marker]
+    dur = segments[segment, 1]
+    early = seg_starts[segment] < m_start
+    dur = np.where(early, dur - (m_start - seg_starts[segment]), dur)
+    weights = np.minimum(dur / m_duration, 1)
+
+    # ...and the final, partial segment for each marker that has one.
+    tail = np.arange(last - 1 if len(overrun) else last)
+    marker = np.concatenate((marker, tail))
+    rank = np.concatenate((rank, counts[tail]))
+    segment = np.concatenate((segment, stop[tail]))
+    weights = np.concatenate((weights, np.minimum(
+        (durations[tail] + starts[tail] - seg_starts[stop[tail]]) /
+        durations[tail], 1)))
+
+    # Rows are float32, so keep each row's additions in their original order.
+    for r in xrange(rank.max() + 1 if len(rank) else 0):
+        chosen = rank == r
+        mat[marker[chosen]] += weights[chosen, np.newaxis] * \
+            features[segment[chosen]]
+    return True
+
+
+def spread_features_serial(mat, segments, features, starts, durations, index):
     try:
-        for (i, m) in enumerate(tmp_markers):
-            while segments[index].start + segments[index].duration < m.start + m.duration:
-                dur = segments[index].duration
-                if segments[index].start < m.start:
-                    dur -= m.start - segments[index].start
+        for i in xrange(len(starts)):
+            m_start, m_duration = starts[i], durations[i]
+            while segments[index, 0] + segments[index, 1] < m_start + m_duration:
+                dur = segments[index, 1]
+                if segments[index, 0] < m_start:
+                    dur -= m_start - segments[index, 0]
 
-                C = min(dur / m.duration, 1)
+                C = min(dur / m_duration, 1)
 
-                mat[i, 0:12] += C * np.array(getattr(segments[index], feature))
+                mat[i, 0:12] += C * features[index]
                 index += 1
 
-            C = min((m.duration + m.start - segments[index].start) / m.duration, 1)
-            mat[i, 0:12] += C * np.array(getattr(segments[index], feature))
+            C = min((m_duration + m_start - segments[index, 0]) / m_duration, 1)
+            mat[i, 0:12] += C * features[index]
     except IndexError:
         pass  # avoid breaking with index > len(segments)
 
+
+def resample_features(data, rate='tatums', feature='timbre'):
+    """
+    Resample segment features to a given rate within fade boundaries.
+    @param data: analysis object.
+    @param rate: one of the following: segments, tatums, beats, bars.
+    @param feature: either timbre or pitch.
+    @return A dictionary including a numpy matrix of size len(rate) x 12, a rate, and an index
+    """
+    return resample_arrays(analysis_arrays(data.analysis, rate, feature), rate)
+
+
+def resample_whitened(arrays, rate='tatums'):
+    """
+    Resample and whiten timbre features from analysis_arrays. This is a
+    module-level function so that it can be run in a worker process.
+    """
+    ret = resample_arrays(arrays, rate)
+    ret['matrix'] = timbre_whiten(ret['matrix'])
     return ret
 
 
@@ -251,13 +416,51 @@ def timbre_whiten(mat):
     return m
 
 
+class MarkerIndex(object):
+    """ Starts and durations of the markers a track was resampled to, from
+        resampled['index'] on, so that cursors can be moved by searching
+        arrays rather than walking the analysis one marker at a time.
+    """
+    def __init__(self, markers, offset=0):
+        spans = spans_of(markers[offset:])
+        self.starts = spans[:, 0]
+        self.durations = spans[:, 1]
+        # sums[i] is the total duration of the first i markers.
+        self.sums = np.concatenate(([0.0], np.cumsum(self.durations)))
+
+    @classmethod
+    def of(cls, track):
+        return cls(getattr(track.analysis, track.resampled['rate']),
+                   track.resampled['index'])
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.durations.nbytes + self.sums.nbytes
+
+    def move(self, duration, cursor, limit):
+        """ Step the cursor over markers until they add up to at least
+            duration, without passing limit. Returns (duration, cursor).
+        """
+        if not 0 < duration or cursor >= limit:
+            return 0, cursor
+        base = self.sums[cursor]
+        ends = self.sums[cursor + 1:limit + 1]
+        steps = int(np.searchsorted(ends, base + duration, 'left'))
+        steps = min(steps + 1, len(ends))
+        return float(ends[steps - 1] - base), cursor + steps
+
+
+def marker_index(track):
+    """ The track's MarkerIndex, which is built once and kept in resampled. """
+    index = track.resampled.get('markers')
+    if index is None:
+        index = track.resampled['markers'] = MarkerIndex.of(track)
+    return index
+
+
 def move_cursor(track, duration, cursor, buf=MIN_MARKERS):
-    dur = 0
-    while dur < duration and cursor < rows(track.resampled['matrix']) - buf:
-        markers = getattr(track.analysis, track.resampled['rate'])
-        dur += markers[track.resampled['index'] + cursor].duration
-        cursor += 1
-    return dur, cursor
+    return marker_index(track).move(duration, cursor,
+                                    rows(track.resampled['matrix']) - buf)
 
 
 def get_mat_out(track, transition):
@@ -272,6 +475,25 @@ def get_mat_out(track, transition):
     return mat[track.resampled['cursor']:cursor, :]
 
 
+def get_mats_out(track, transition, candidates=1, window=0):
+    """ Find the matrices for up to `candidates` possible transitions out of
+        track: one at the cursor (as get_mat_out), and the rest spread over
+        the following `window` seconds, all with the same number of rows.
+        Returns the cursor of each candidate, and a stack of the matrices.
+    """
+    cursor = track.resampled['cursor']
+    mat = track.resampled['matrix']
+    n = rows(get_mat_out(track, transition))
+
+    # Later candidates need room for their own matrix after them.
+    last = cursor
+    if candidates > 1 and window > 0:
+        _, last = move_cursor(track, window, cursor, buf=MIN_MARKERS + n)
+        last = max(last, cursor)
+    cursors = np.unique(np.linspace(cursor, last, candidates).astype(int))
+    return cursors, mat[cursors[:, np.newaxis] + np.arange(n)]
+
+
 def get_mat_in(track, transition, inter):
     """ Find and output the search matrix to use in the next alignment.
         Assumes that track.resampled exists.
@@ -321,19 +543,21 @@ def make_crossfade(track1, track2, inter):
 
 
 def make_crossmatch(track1, track2, rate1, rate2, loc2, rows):
-    markers1 = upsample_list(getattr(track1.analysis, track1.resampled['rate']), rate1)
-    markers2 = upsample_list(getattr(track2.analysis, track2.resampled['rate']), rate2)
-
-    def to_tuples(l, i, n):
-        return [(t.start, t.duration) for t in l[i : i + n]]
+    markers1 = getattr(track1.analysis, track1.resampled['rate'])
+    markers2 = getattr(track2.analysis, track2.resampled['rate'])
 
     start1 = rate1 * (track1.resampled['index'] + track1.resampled['cursor'])
     start2 = loc2 + rate2 * track2.resampled['index']  # loc2 has already been multiplied by rate2
 
-    return Crossmatch((track1, track2), (to_tuples(markers1, start1, rows), to_tuples(markers2, start2, rows)))
+    return Crossmatch((track1, track2), (upsample_spans(markers1, rate1, start1, rows),
+                                         upsample_spans(markers2, rate2, start2, rows)))
 
 
-def make_transition(track1, track2, inter, transition):
+def make_transition(track1, track2, inter, transition, candidates=1, window=0):
+    """ Beat-match track1 into track2. If candidates > 1, that many places to
+        leave track1 - spread over `window` seconds from its cursor - are
+        scored together, and track1 plays on until the best one.
+    """
     # the minimal transition is 2 markers
     # the minimal inter is 0 sec
     markers1 = getattr(track1.analysis, track1.resampled['rate'])
@@ -344,14 +568,27 @@ def make_transition(track1, track2, inter, transition):
         return make_crossfade(track1, track2, inter)
 
     # though the minimal transition is 2 markers, the alignment is on at least 3 seconds
-    mat1 = get_mat_out(track1, max(transition, MIN_ALIGN_DURATION))
+    cursors, mats1 = get_mats_out(track1, max(transition, MIN_ALIGN_DURATION),
+                                  candidates, window)
     mat2 = get_mat_in(track2, max(transition, MIN_ALIGN_DURATION), inter)
 
     try:
-        loc, n, rate1, rate2 = align(track1, track2, mat1, mat2)
+        k, loc, n, rate1, rate2, score = align_candidates(track1, track2, mats1, mat2)
     except Exception:
         return make_crossfade(track1, track2, inter)
 
+    actions = []
+    if cursors[k] != track1.resampled['cursor']:
+        # Play on through track1 until the transition we picked.
+        start = markers1[track1.resampled['index'] + track1.resampled['cursor']].start
+        track1.resampled['cursor'] = int(cursors[k])
+        end = markers1[track1.resampled['index'] + track1.resampled['cursor']].start
+        actions.append(Playback(track1, start, end - start))
+    if len(cursors) > 1:
+        logging.getLogger(__name__).debug(
+            "Chose transition %d of %d (distance %.3f).",
+            k + 1, len(cursors), score)
+
     if transition < MIN_ALIGN_DURATION:
         print "Transition is less than minimum alignment duration!"
         duration, cursor = move_cursor(track2, transition, loc)
@@ -369,7 +606,7 @@ def make_transition(track1, track2, inter, transition):
     dur, track2.resampled['cursor'] = move_cursor(track2, inter, end_crossmatch)
     pb = Playback(track2, sum(xm.l2[-1]), dur)
 
-    return [xm, pb]
+    return actions + [xm, pb]
 
 
 def initialize(track, inter, transition, fade_in=FADE_IN):
@@ -0,0 +1,158 @@
+"""
+compactanalysis.py
+
+Compact, array-backed stand-in for echonest's AudioAnalysis. Rather than
+keeping thousands of AudioQuantum objects (each with its own timbre and
+pitch lists) alive for as long as a track is queued, every quantum list is
+stored as a handful of contiguous numpy arrays. Indexing a list still
+hands back an object with the usual attributes, so the capsule_support
+code doesn't need to know the difference.
+
+Compact analyses can be written to and read back from disk.
+"""
+
+import json
+import numpy
+
+VERSION = 1
+
+QUANTA = ('sections', 'bars', 'beats', 'tatums', 'segments')
+COLUMNS = ('start', 'duration', 'confidence')
+SEGMENT_COLUMNS = COLUMNS + ('loudness_max', 'timbre', 'pitches')
+
+#   Scalar attributes of the analysis, and of analysis.pyechonest_track,
+#   that we keep around (if the original analysis had them).
+FIELDS = ('duration', 'loudness', 'tempo', 'key', 'mode', 'time_signature',
+          'end_of_fade_in', 'start_of_fade_out')
+TRACK_FIELDS = ('id', 'title', 'artist', 'audio_md5', 'duration', 'key',
+                'mode', 'time_signature', 'danceability', 'energy',
+                'loudness', 'tempo', 'echoprintstring')
+
+
+class Summary(object):
+    """Stand-in for analysis.pyechonest_track: just a bag of attributes."""
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+class Quantum(object):
+    """One row of a Quanta list, materialized as a plain object."""
+    def __init__(self, index, columns):
+        self._index = index
+        self.__dict__.update(columns)
+
+    def __repr__(self):
+        return "<Quantum %.3f (%.3f)>" % (self.start, self.duration)
+
+
+class Quanta(object):
+    """
+    Array-backed replacement for an AudioQuantumList. Supports len(),
+    iteration, integer and slice indexing, and .index() of its own items.
+    """
+    def __init__(self, columns, offset=0):
+        self.columns = columns
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, _, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("Quanta can't be sliced with a step.")
+            return Quanta(dict((k, v[i]) for k, v in self.columns.iteritems()),
+                          self.offset + start)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Quanta index out of range")
+        return Quantum(self.offset + i, dict(
+            (k, v[i] if v.ndim > 1 else float(v[i]))
+            for k, v in self.columns.iteritems()
+        ))
+
+    def index(self, quantum):
+        i = getattr(quantum, '_index', -1) - self.offset
+        if not 0 <= i < len(self):
+            raise ValueError("Quanta.index(x): x not in list")
+        return i
+
+    def column(self, name):
+        return self.columns[name]
+
+    @property
+    def spans(self):
+        """A (len x 2) array of (start, duration) rows."""
+        return numpy.column_stack((self.columns['start'],
+                                   self.columns['duration']))
+
+
+class CompactAnalysis(object):
+    def __init__(self, fields, summary, quanta):
+        self.__dict__.update(fields)
+        self.pyechonest_track = Summary(summary)
+        for kind, columns in quanta.iteritems():
+            setattr(self, kind, Quanta(columns))
+
+    @classmethod
+    def from_analysis(cls, analysis):
+        fields = dict((f, getattr(analysis, f)) for f in FIELDS
+                      if hasattr(analysis, f))
+        track = getattr(analysis, 'pyechonest_track', None)
+        summary = dict((f, getattr(track, f)) for f in TRACK_FIELDS
+                       if hasattr(track, f))
+        quanta = {}
+        for kind in QUANTA:
+            members = list(getattr(analysis, kind, []))
+            columns = SEGMENT_COLUMNS if kind == 'segments' else COLUMNS
+            quanta[kind] = {}
+            for column in columns:
+                values = [getattr(m, column, 0) for m in members]
+                if column in ('timbre', 'pitches'):
+                    a = numpy.array(values, dtype=numpy.float64)\
+                             .reshape(len(members), 12)
+                else:
+                    a = numpy.array(values, dtype=numpy.float64)
+                quanta[kind][column] = a
+        return cls(fields, summary, quanta)
+
+    def save(self, f):
+        """Write this analysis to a filename or file object, compressed."""
+        header = {
+            'version': VERSION,
+            'fields': dict((k, getattr(self, k)) for k in FIELDS
+                           if hasattr(self, k)),
+            'summary': self.pyechonest_track.__dict__,
+        }
+        arrays = {'header': numpy.array(json.dumps(header))}
+        for kind in QUANTA:
+            for column, a in getattr(self, kind).columns.iteritems():
+                arrays["%s.%s" % (kind, column)] = a
+        numpy.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, f):
+        """
+        Read an analysis written by save. Raises ValueError if the file
+        was written by an incompatible version.
+        """
+        z = numpy.load(f)
+        try:
+            header = json.loads(z['header'].item())
+            if header.get('version') != VERSION:
+                raise ValueError("Analysis version %s is not %s."
+                                 % (header.get('version'), VERSION))
+            quanta = dict((kind, {}) for kind in QUANTA)
+            for key in z.files:
+                if key != 'header':
+                    kind, column = key.split('.', 1)
+                    quanta[kind][column] = z[key]
+        finally:
+            z.close()
+        return cls(header['fields'], header['summary'], quanta)
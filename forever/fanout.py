@@ -0,0 +1,165 @@
+"""
+fanout.py
+
+Renders each action once and feeds the same PCM to several encoders (i.e.:
+one per bitrate) at the same time. Every encoder has its own queue and
+feeder thread, so a slow encoder can't hold up the others.
+
+Actions are rendered on a thread of their own, so that the mixer can plan
+ahead while they are. The first encoder sets the pace: rendering waits for
+it to have room, and add_pcm waits while it has a full buffer's worth of
+actions still to render.
+Any other encoder that falls more than `backlog` samples behind has audio
+dropped instead - its listeners hear a skip, but everybody else is fine.
+"""
+
+import numpy
+import logging
+import threading
+import traceback
+from Queue import Queue
+from cube import emit
+from mixing import keep
+from samplechannel import SampleChannel
+
+log = logging.getLogger(__name__)
+
+
+class Branch(threading.Thread):
+    """Hands queued chunks of PCM to one encoder, in order."""
+    def __init__(self, encoder, backlog):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.encoder = encoder
+        self.backlog = backlog
+        self.pending = 0        # samples queued but not yet encoded
+        self.dropped = 0        # samples thrown away since we fell behind
+        self.queue = Queue()
+        self.__cond = threading.Condition()
+
+    def put(self, chunk, block=False, marker=None):
+        """Queue chunk for the encoder. Returns False if it was dropped."""
+        with self.__cond:
+            while block and self.pending and \
+                    self.pending + len(chunk) > self.backlog:
+                self.__cond.wait()
+            if self.pending + len(chunk) > self.backlog:
+                if not self.dropped:
+                    log.warning("Encoder %d is falling behind. Dropping audio.",
+                                id(self.encoder))
+                self.dropped += len(chunk)
+                return False
+            if self.dropped:
+                log.info("Encoder %d caught up after dropping %d samples.",
+                         id(self.encoder), self.dropped)
+                emit('encoder_dropped', {"samples": self.dropped})
+                self.dropped = 0
+            self.pending += len(chunk)
+        self.queue.put((chunk, marker))
+        return True
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            chunk, marker = item
+            try:
+                self.encoder.add_pcm(chunk, marker)
+            except Exception:
+                log.error("Could not encode chunk:\n%s", traceback.format_exc())
+            finally:
+                with self.__cond:
+                    self.pending -= len(chunk)
+                    self.__cond.notify_all()
+
+    def finish(self):
+        self.queue.put(None)
+
+
+class Fanout(object):
+    def __init__(self, encoders, chunk_size, backlog):
+        self.encoders = encoders
+        self.chunk_size = chunk_size
+        self.branches = []
+        if len(encoders) > 1:
+            self.branches = [Branch(e, backlog) for e in encoders]
+            for branch in self.branches:
+                branch.start()
+
+            #   Actions waiting to be rendered, held to the same limit as
+            #   the first encoder's own input.
+            self.pending = SampleChannel(encoders[0].channel.capacity)
+            self.__added = 0
+            self.__rendered = 0
+            self.__rendered_samples = 0
+            self.__progress = threading.Condition()
+            self.renderer = threading.Thread(target=self.__render)
+            self.renderer.daemon = True
+            self.renderer.start()
+
+    def add_pcm(self, action, marker=None):
+        """
+        Queue action to be rendered once for every encoder. The marker goes
+        to the first encoder only. Blocks while the first encoder has as
+        much audio waiting as it would itself.
+        """
+        if not self.branches:
+            #   Nothing to share, so let the encoder render as it goes.
+            return self.encoders[0].add_pcm(action, marker)
+
+        with self.__progress:
+            self.__added += 1
+        if not self.pending.put((action, marker), action.samples):
+            with self.__progress:
+                self.__added -= 1
+            return False
+        return True
+
+    def __render(self):
+        primary, others = self.branches[0], self.branches[1:]
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            action, marker = item
+            try:
+                for chunk in action.render(self.chunk_size):
+                    chunk = keep(chunk)
+                    primary.put(chunk, block=True, marker=marker)
+                    marker = None
+                    for branch in others:
+                        branch.put(chunk)
+                if marker is not None:
+                    #   Nothing was rendered, but the marker still has to go out.
+                    primary.put(numpy.zeros((0, 2), dtype=numpy.int16), True,
+                                marker)
+            except Exception:
+                log.error("Could not render %s:\n%s", action,
+                          traceback.format_exc())
+            finally:
+                self.__rendered_samples += action.samples
+                self.pending.drained(self.__rendered_samples)
+                with self.__progress:
+                    self.__rendered += 1
+                    self.__progress.notify_all()
+
+    def drain(self, pending=0):
+        """
+        Wait until every action added so far, except for the last `pending`
+        actions, has been rendered.
+        """
+        if not self.branches:
+            self.encoders[0].drain(pending)
+            return
+        with self.__progress:
+            target = self.__added - pending
+            while self.__rendered < target and self.renderer.is_alive():
+                self.__progress.wait(1)
+
+    def finish(self):
+        if self.branches:
+            self.pending.close()
+            self.renderer.join()
+        for branch in self.branches:
+            branch.finish()
@@ -3,6 +3,7 @@ import base64
 import logging
 import traceback
 import scwaveform
+from lame import FrameClock
 from metadata import Metadata
 
 log = logging.getLogger(__name__)
@@ -13,11 +14,16 @@ def generate(iq, first_frame):
     first_frame.acquire()
     stime = time.time()
     log.info("Info generator got first frame! Start time: %2.2f", stime)
+    clock = FrameClock()
     samples = 0L
     while True:
         try:
             action = iq.get()
-            action['time'] = stime + (samples / 44100.0)
+            #   The encoder tells us exactly when each action is heard, by
+            #   its own clock; the running total of nominal lengths (with a
+            #   nominal encoder delay) is a fallback.
+            samples = action.get('start_sample', samples)
+            action['time'] = stime + action.get('offset', clock.offset(samples))
             samples += action['samples']
             try:
                 if len(action['tracks']) == 2:
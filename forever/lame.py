@@ -1,11 +1,14 @@
-from Queue import Queue
+from collections import deque
 import subprocess
+import os
 import threading
 import traceback
 import logging
 import numpy
 import time
 from cube import emit
+from mixing import keep
+from samplechannel import SampleChannel
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -57,17 +60,172 @@ SAMPLERATE_TABLE = [
 HEADER_SIZE = 4
 SAMPLES_PER_FRAME = 1152
 
+#   LAME holds back this many samples before the first real audio comes out,
+#   and an MP3 decoder holds back another DECODER_DELAY on the way back out.
+ENCODER_DELAY = 576
+DECODER_DELAY = 529
+
+#   The most audio LAME holds on to without producing any output for it.
+ENCODER_LAG = 8 * SAMPLES_PER_FRAME
+
+#   LAME options for each of config.yml's encoder_profiles. VBR frames borrow
+#   space from earlier frames (the "bit reservoir"), so can't be decoded on
+#   their own; splice_safe turns that off, so that every frame can be.
+PROFILES = {
+    'vbr': "-V3",
+    'splice_safe': "--cbr -b %(bitrate)d --nores",
+}
+
 
 def avg(l):
     return sum(l) / len(l)
 
 
+#   Frame length in bytes, indexed by [bitrate index][samplerate index][padding]
+#   straight from the header bits - None for reserved or free-format values.
+FRAME_LENGTHS = [[[
+    int((float(SAMPLES_PER_FRAME) / sample_rate) * ((bitrate / 8) * 1000))
+    + padding if bitrate and sample_rate else None
+    for padding in (0, 1)]
+    for sample_rate in SAMPLERATE_TABLE]
+    for bitrate in BITRATE_TABLE]
+
+READ_SIZE = 16384   # bytes to ask for from LAME at once
+
+
+class FrameClock(object):
+    """
+    Maps positions in the PCM given to the encoder onto the MP3 frames that
+    come out of it. Frame n carries output samples [n * 1152, (n + 1) * 1152),
+    and PCM sample s comes out `delay` samples late, so it lands in frame
+    (s + delay) // 1152. This is the one place that sums that up; anything
+    that converts between samples, frames and seconds should go through it.
+    """
+    def __init__(self, delay=ENCODER_DELAY, samplerate=44100):
+        self.delay = delay
+        self.samplerate = samplerate
+
+    def frame_of(self, sample):
+        """Index of the output frame that PCM sample `sample` ends up in."""
+        return (sample + self.delay) // SAMPLES_PER_FRAME
+
+    def sample_of(self, frame):
+        """The first PCM sample in output frame `frame` (negative: padding)."""
+        return frame * SAMPLES_PER_FRAME - self.delay
+
+    def seconds(self, frames):
+        """How long `frames` output frames take to play."""
+        return frames * SAMPLES_PER_FRAME / float(self.samplerate)
+
+    def offset(self, sample):
+        """
+        Seconds from the start of the first frame until PCM sample `sample`
+        is heard by a listener, including their decoder's delay.
+        """
+        return (sample + self.delay + DECODER_DELAY) / float(self.samplerate)
+
+ID3_HEADER_SIZE = 10
+XING_TAGS = ('Xing', 'Info')
+
+
 def frame_length(header):
-    bitrate = BITRATE_TABLE[ord(header[2]) >> 4]
-    sample_rate = SAMPLERATE_TABLE[(ord(header[2]) & 0b00001100) >> 2]
-    padding = (ord(header[2]) & 0b00000010) >> 1
-    return int((float(SAMPLES_PER_FRAME) / sample_rate)
-               * ((bitrate / 8) * 1000)) + padding
+    b = ord(header[2])
+    return FRAME_LENGTHS[b >> 4][(b & 0b00001100) >> 2][(b & 0b00000010) >> 1]
+
+
+def splice_point(frame):
+    """
+    True if a decoder could start at this frame: i.e.: none of its audio is
+    in the bit reservoir of earlier frames (its main_data_begin is zero).
+    """
+    #   Side info follows the header - and its CRC, if the frame has one.
+    side_info = HEADER_SIZE if ord(frame[1]) & 1 else HEADER_SIZE + 2
+    return ord(frame[side_info]) == 0 and not ord(frame[side_info + 1]) & 0x80
+
+
+class FrameSplitter(object):
+    """
+    Splits a stream of MP3 data into frames. Reads in large blocks, and
+    yields each frame as a memoryview over the block it came in.
+
+    Only MPEG-1 Layer III frames are passed on. ID3 tags, Xing/Info frames
+    (which carry no audio) and any junk in between frames are skipped over,
+    and counted in skipped_bytes.
+    """
+    def __init__(self, read, read_size=READ_SIZE):
+        self.read = read
+        self.read_size = read_size
+        self.skipped_bytes = 0
+
+    def __iter__(self):
+        data, pos, skip = '', 0, 0
+        while True:
+            block = self.read(self.read_size)
+            if not block:
+                self.skipped_bytes += len(data) - pos
+                return
+            if skip:
+                #   Still in the middle of a tag from the last block.
+                n = min(skip, len(block))
+                block, skip = block[n:], skip - n
+            data, pos = data[pos:] + block, 0
+            view = memoryview(data)
+            while True:
+                length, is_audio = self.frame_at(data, pos)
+                if length is None:
+                    break   # need more data
+                if not length:
+                    #   Not a frame: resync at the next possible header.
+                    sync = data.find('\xff', pos + 1)
+                    if sync < 0:
+                        sync = len(data)
+                    self.skipped_bytes += sync - pos
+                    pos = sync
+                    continue
+                if is_audio:
+                    if pos + length > len(data):
+                        break
+                    yield view[pos:pos + length]
+                else:
+                    self.skipped_bytes += length
+                    skip = max(pos + length - len(data), 0)
+                pos = min(pos + length, len(data))
+
+    def frame_at(self, data, pos):
+        """
+        Returns (length, is_audio) for whatever starts at data[pos].
+        A length of 0 means junk; None means there isn't enough data to
+        tell yet.
+        """
+        if len(data) - pos < HEADER_SIZE:
+            return None, False
+        if data.startswith('ID3', pos):
+            if len(data) - pos < ID3_HEADER_SIZE:
+                return None, False
+            size = 0
+            for c in data[pos + 6:pos + 10]:  # "syncsafe": 7 bits per byte
+                size = (size << 7) | (ord(c) & 0x7f)
+            if ord(data[pos + 5]) & 0x10:     # footer present
+                size += ID3_HEADER_SIZE
+            return size + ID3_HEADER_SIZE, False
+
+        b1, b2, b3 = ord(data[pos + 1]), ord(data[pos + 2]), ord(data[pos + 3])
+        #   Frame sync, MPEG-1, Layer III. Protection bit may be either.
+        if data[pos] != '\xff' or (b1 & 0b11111110) != 0b11111010:
+            return 0, False
+        length = FRAME_LENGTHS[b2 >> 4][(b2 & 0b00001100) >> 2][(b2 & 0b00000010) >> 1]
+        if length is None:
+            return 0, False
+
+        #   Xing/Info tags live where the audio data would otherwise start,
+        #   right after the side information.
+        side_info = 17 if (b3 >> 6) == 0b11 else 32
+        tag = pos + HEADER_SIZE + side_info + (0 if b1 & 1 else 2)
+        if len(data) < tag + 4:
+            if pos + length <= len(data):
+                return length, True
+            return None, False
+        return length, data[tag:tag + 4] not in XING_TAGS
 
 
 class Lame(threading.Thread):
@@ -75,6 +233,8 @@ class Lame(threading.Thread):
         Live MP3 streamer. Currently only works for 16-bit, 44.1kHz stereo input.
     """
     safety_buffer = 30  # seconds
+    stall_timeout = 10  # seconds without output before LAME is restarted
+    max_restarts = 3    # in a row, without any output in between
     input_wordlength = 16
     samplerate = 44100
     channels = 2
@@ -88,28 +248,50 @@ class Lame(threading.Thread):
     stream_chunk_size = samplerate / 8
     data = None
 
-    def __init__(self, callback=None, ofile=None, oqueue=None, syncqueue=None):
+    def __init__(self, callback=None, ofile=None, oqueue=None, syncqueue=None,
+                 preset=None, safety_buffer=None, stall_timeout=None):
         threading.Thread.__init__(self)
+        if preset is not None:
+            self.preset = preset
+        if safety_buffer is not None:
+            self.safety_buffer = safety_buffer
+        if stall_timeout is not None:
+            self.stall_timeout = stall_timeout
 
         self.lame = None
-        self.buffered = 0
-        self.lame_input_length = 0
+        self.clock = FrameClock(samplerate=self.samplerate)
+        self.written = 0        # exact PCM samples handed to the encoder
+        self.frames = 0         # MP3 frames that have come back out
         self.in_samples = 0
-        self.out_samples = 0
         self.delta = 0
         self.oqueue = oqueue
         self.syncqueue = syncqueue
         self.ofile = ofile
         self.callback = callback
 
-        self.markers = []
+        self.markers = deque()
         self.finished = False
         self.sent = False
-        self.ready = threading.Semaphore()
-        self.encode = threading.Semaphore()
         self.setDaemon(True)
 
-        self.__write_queue = Queue()
+        #   PCM written to LAME that it might not have encoded yet, as
+        #   (first sample, PCM) - replayed into a new LAME if this one dies.
+        self.history = deque()
+        self.restarts = 0
+        self.__failures = 0
+        self.__closing = False
+        self.__reading_since = None
+        self.__write_lock = threading.Lock()
+        self.__restarted = threading.Condition()
+
+        #   PCM waiting to be encoded, at most safety_buffer seconds of it.
+        self.channel = SampleChannel(self.safety_buffer * self.samplerate,
+                                     ENCODER_LAG)
+        #   Items given to add_pcm, and items written to LAME in full.
+        self.__queued = 0
+        self.__written_items = 0
+        self.__writing = True
+        self.__progress = threading.Condition()
         self.__write_thread = threading.Thread(target=self.__lame_write)
         self.__write_thread.setDaemon(True)
         self.__write_thread.start()
@@ -118,26 +300,53 @@ class Lame(threading.Thread):
     def pcm_datarate(self):
         return self.samplerate * self.channels * (self.input_wordlength / 8)
 
+    @property
+    def buffered(self):
+        """Samples given to add_pcm that haven't come out as MP3 yet."""
+        return self.channel.occupancy
+
+    @property
+    def out_samples(self):
+        return self.frames * SAMPLES_PER_FRAME
+
+    def frame_of(self, sample):
+        return self.clock.frame_of(sample)
+
+    def sample_of(self, frame):
+        return self.clock.sample_of(frame)
+
+    def samples_in(self, data):
+        """Number of (multi-channel) samples in an array of PCM."""
+        if data.ndim > 1:
+            return len(data)
+        return len(data) / self.channels
+
     def add_pcm(self, data, marker=None):
         """
         Expects PCM data in the form of a NumPy array,
         or an AudioRenderable that will be sliced according to the start and end.
 
+        If given, marker (a dict) is put on the syncqueue as soon as the
+        first frame containing this data has been emitted, along with the
+        exact sample (`start_sample`) and frame (`frame`) it starts at, and
+        when a listener hears it (`offset`, in seconds from the first frame).
+
+        Blocks while safety_buffer seconds of audio are waiting to be encoded.
         """
-        if self.lame.returncode is not None:
+        if self.finished:
             return False
-        # TODO: Implement me
-        #self.markers.append((self.in_samples, marker))
-        self.encode.acquire()
         if isinstance(data, numpy.ndarray):
-            samples = len(data)
+            samples = self.samples_in(data)
         else:
             samples = data.samples
-        self.__write_queue.put(data)
-        self.in_samples += samples
         put_time = time.time()
-        if self.buffered >= self.safety_buffer:
-            self.ready.acquire()
+        with self.__progress:
+            self.__queued += 1
+        if not self.channel.put((data, marker), samples):
+            with self.__progress:
+                self.__queued -= 1
+            return False
+        self.in_samples += samples
         done_time = time.time()
         if self.block and not self.real_time:
             delay = (samples / float(self.samplerate)) \
@@ -149,49 +358,109 @@ class Lame(threading.Thread):
     def __lame_write(self):
         while not self.finished:
             try:
-                data = self.__write_queue.get()
-                if data is None:
+                item = self.channel.get()
+                if item is None:
                     break
+                data, marker = item
+                if marker is not None:
+                    self.markers.append((self.written, marker))
                 if isinstance(data, numpy.ndarray):
-                    self.buffered += len(data) / self.channels \
-                                            * (self.input_wordlength / 8)
-                    try:
-                        data.tofile(self.lame.stdin)
-                    except IOError:
-                        log.error("Could not write to lame!")
-                        self.finished = True
+                    if not self.__encode(data):
                         break
                 else:
+                    tmp = 0
                     try:
-                        tmp = 0
                         for chunk in data.render(self.stream_chunk_size):
-                            try:
-                                samples = len(chunk)
-                                self.buffered += samples
-                                self.lame_input_length += samples
-                                tmp += samples
-                                chunk.tofile(self.lame.stdin)
-                            except IOError:
-                                log.error("Could not write to lame!")
-                                self.finished = True
+                            chunk = keep(chunk)     # kept for replay
+                            tmp += self.samples_in(chunk)
+                            if not self.__encode(chunk):
                                 break
-                        self.delta += tmp - data.samples
-                        log.debug("Current delta: %d samples.", self.delta)
-                        #   Note: this delta will cause drift of 1 second/month.
-                        #   TODO: Fix it. Eventually.
-                        emit('lame_delta', {"samples": self.delta})
+                        else:
+                            #   Renderers can be a few samples off of their
+                            #   nominal length; timing is based on `written`,
+                            #   so this is only of interest, not drift.
+                            self.delta += tmp - data.samples
+                            log.debug("Current delta: %d samples.", self.delta)
+                            emit('lame_delta', {"samples": self.delta})
                     except:
                         log.error("Couldn't render segment due to:\n%s",
                                 traceback.format_exc())
+                    finally:
+                        #   Only count what actually made it to the encoder,
+                        #   even if the rest of this never will.
+                        self.channel.adjust(tmp - data.samples)
             except:
                 log.critical("Failed to write to Lame:\n%s",
                              traceback.format_exc())
             finally:
-                self.encode.release()
+                with self.__progress:
+                    self.__written_items += 1
+                    self.__progress.notify_all()
+        #   Don't leave anybody waiting for room that will never come.
+        self.channel.close()
+        with self.__progress:
+            self.__writing = False
+            self.__progress.notify_all()
         log.critical("Encoder finishing!")
 
+    def drain(self, pending=0):
+        """
+        Wait until everything passed to add_pcm so far, except for the last
+        `pending` items, has been rendered and written to LAME - i.e.: until
+        none of it still needs to read from the tracks that it came from.
+        """
+        with self.__progress:
+            target = self.__queued - pending
+            while self.__written_items < target and self.__writing:
+                self.__progress.wait()
+
+    def __encode(self, pcm):
+        """
+        Write PCM to LAME, keeping it in case LAME needs to be restarted.
+        If LAME has gone away, waits for it to be restarted (which replays
+        this PCM). Returns False if the encoder is gone for good.
+        """
+        with self.__write_lock:
+            restarts = self.restarts
+            self.history.append((self.written, pcm))
+            self.written += self.samples_in(pcm)
+            self.__trim_history()
+            try:
+                self.write(pcm)
+                return True
+            except IOError:
+                log.error("Could not write to LAME!")
+                #   Make sure the run thread notices - but only if it hasn't
+                #   already replaced the LAME that we were writing to.
+                if self.restarts == restarts:
+                    self.abort()
+        with self.__restarted:
+            while self.restarts == restarts and not self.finished:
+                self.__restarted.wait()
+        return not self.finished
+
+    def __trim_history(self):
+        #   Anything before the frame preceding the next one to come out of
+        #   LAME will never be needed again.
+        keep = self.replay_from
+        while self.history:
+            start, pcm = self.history[0]
+            if start + self.samples_in(pcm) > keep:
+                break
+            self.history.popleft()
+
+    @property
+    def replay_from(self):
+        """
+        The sample that a new LAME would need to start from to have its
+        second frame line up exactly with our next frame (its first frame
+        is taken up by its encoder delay).
+        """
+        return max(0, (self.frames - 1) * SAMPLES_PER_FRAME)
+
     #   TODO: Extend me to work for all samplerates
-    def start(self, *args, **kwargs):
+    def spawn(self):
+        """Start the encoder - here, a LAME process."""
         call = ["lame"]
         call.append('-r')
         if self.input_wordlength != 16:
@@ -204,7 +473,41 @@ class Lame(threading.Thread):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE
         )
+
+    def write(self, data):
+        """Send int16 PCM to the encoder. Raises IOError if it's gone."""
+        data.tofile(self.lame.stdin)
+
+    def read(self, size):
+        """Up to size bytes of MP3 from the encoder; '' once it's done."""
+        #   os.read returns whatever's ready, rather than waiting for it all.
+        return os.read(self.lame.stdout.fileno(), size)
+
+    def close(self):
+        """Tell the encoder there's no more input coming."""
+        self.lame.stdin.close()
+
+    def abort(self):
+        """Stop the encoder right now, without waiting for its output."""
+        if self.lame.poll() is None:
+            try:
+                self.lame.kill()
+            except OSError:
+                pass
+
+    def wait(self):
+        self.lame.wait()
+
+    @property
+    def returncode(self):
+        return self.lame.returncode
+
+    def start(self, *args, **kwargs):
+        self.spawn()
         threading.Thread.start(self, *args, **kwargs)
+        watchdog = threading.Thread(target=self.__watch)
+        watchdog.setDaemon(True)
+        watchdog.start()
 
     def ensure_is_alive(self):
         if self.finished:
@@ -221,33 +524,26 @@ class Lame(threading.Thread):
         try:
             last = None
             lag = 0
+            timing = float(SAMPLES_PER_FRAME) / self.samplerate
+            skip = 0
             while True:
-                timing = float(SAMPLES_PER_FRAME) / self.samplerate
-
-                header = self.lame.stdout.read(HEADER_SIZE)
-                if len(header) == HEADER_SIZE:
-                    frame_len = frame_length(header) - HEADER_SIZE
-                    frame = self.lame.stdout.read(frame_len)
-                    buf = header + frame
-                    if len(frame) == frame_len:
-                        self.buffered -= SAMPLES_PER_FRAME
-                else:
-                    buf = header
-
-                if self.buffered < (self.safety_buffer * self.samplerate):
-                    self.ready.release()
-                if len(buf):
-                    self.out_samples += SAMPLES_PER_FRAME
+                for frame in FrameSplitter(self.__read):
+                    if skip:
+                        #   A restarted LAME's first frame is encoder delay.
+                        skip -= 1
+                        continue
+                    buf = frame.tobytes()
+                    self.frames += 1
+                    self.__failures = 0
+                    self.channel.drained(self.sample_of(self.frames))
                     if self.ofile:
                         self.ofile.write(buf)
                         self.ofile.flush()
                     if self.callback:
                         self.callback(False)
-                    #if self.syncqueue and \
-                    #   self.markers and self.markers[0][0] < self.out_samples:
-                    #    self.syncqueue.put(self.markers.pop(0)[1])
                     if self.oqueue:
                         self.oqueue.put(buf)
+                    self.__release_markers()
                     if self.real_time and self.sent:
                         now = time.time()
                         if last:
@@ -257,28 +553,114 @@ class Lame(threading.Thread):
                                 time.sleep(max(0, timing - delta))
                         last = now
                     self.sent = True
-                else:
-                    if self.callback:
-                        self.callback(True)
+                if self.__closing:
+                    break
+                skip = self.__restart()
+                if skip is None:
                     break
-            self.lame.wait()
+            if self.callback:
+                self.callback(True)
+            self.wait()
         except:
             log.error(traceback.format_exc())
             self.finish()
             raise
 
+    def __read(self, size):
+        self.__reading_since = time.time()
+        try:
+            return self.read(size)
+        finally:
+            self.__reading_since = None
+
+    def __watch(self):
+        """Aborts LAME if it stops producing output for no good reason."""
+        while not self.finished and not self.__closing:
+            time.sleep(1)
+            since = self.__reading_since
+            if since is None or time.time() - since < self.stall_timeout:
+                continue
+            pending = self.written - self.sample_of(self.frames)
+            if pending > ENCODER_LAG:
+                log.error("LAME hasn't produced anything for %2.2fs. "
+                          "Aborting it.", time.time() - since)
+                emit('encoder_stall', {"frames": self.frames})
+                self.abort()
+
+    def __restart(self):
+        """
+        Start a new LAME after the last one died or stalled, and replay all
+        of the PCM that it hadn't encoded yet. Returns the number of frames
+        of the new LAME's output to throw away so that it picks up exactly
+        where the last one left off, or None if it can't be restarted.
+        """
+        self.abort()
+        self.wait()
+        log.error("LAME stopped unexpectedly (%r) after %d frames.",
+                  self.returncode, self.frames)
+        self.__failures += 1
+        emit('encoder_restart', {"frames": self.frames})
+
+        with self.__write_lock:
+            if self.__failures <= self.max_restarts:
+                try:
+                    self.spawn()
+                except Exception:
+                    log.critical("Could not restart LAME:\n%s",
+                                 traceback.format_exc())
+                    self.__failures = self.max_restarts + 1
+            if self.__failures > self.max_restarts:
+                log.critical("Giving up on LAME.")
+                self.finished = True
+                self.channel.close()
+            else:
+                origin = self.replay_from
+                log.warning("Restarted LAME. Replaying %d samples.",
+                            self.written - origin)
+                for start, pcm in self.history:
+                    if start + self.samples_in(pcm) <= origin:
+                        continue
+                    if start < origin:
+                        offset = origin - start
+                        if pcm.ndim == 1:
+                            offset *= self.channels
+                        pcm = pcm[offset:]
+                    try:
+                        self.write(pcm)
+                    except IOError:
+                        #   This one's already gone, too - try again.
+                        break
+                self.restarts += 1
+
+        with self.__restarted:
+            self.__restarted.notify_all()
+        if self.finished:
+            return None
+        return 1 if self.frames else 0
+
+    def __release_markers(self):
+        while self.markers and \
+                self.frame_of(self.markers[0][0]) < self.frames:
+            sample, marker = self.markers.popleft()
+            marker['start_sample'] = sample
+            marker['frame'] = self.frame_of(sample)
+            marker['offset'] = self.clock.offset(sample)
+            if self.syncqueue:
+                self.syncqueue.put(marker)
+
     def finish(self):
         """
             Closes input stream to LAME and waits for the last frame(s) to
             finish encoding. Returns LAME's return value code.
         """
         if self.lame:
-            self.__write_queue.put(None)
-            self.encode.acquire()
-            self.lame.stdin.close()
+            self.channel.close()
+            self.__write_thread.join()
+            self.__closing = True
+            self.close()
             self.join()
             self.finished = True
-            return self.lame.returncode
+            return self.returncode
         return -1
 
 
@@ -290,8 +672,7 @@ if __name__ == "__main__":
 
     s = time.time()
     print "Encoding test.wav to testout.mp3..."
-    encoder = Lame(ofile=open('testout.mp3', 'w'))
-    encoder.safety_buffer = 30
+    encoder = Lame(ofile=open('testout.mp3', 'w'), safety_buffer=30)
     encoder.start()
     encoder.add_pcm(a)
     encoder.finish()
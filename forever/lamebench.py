@@ -0,0 +1,151 @@
+"""
+lamebench.py
+
+Benchmarks our MP3 encoders on synthetic PCM. For each encoder backend
+that can be started here (see mixer.start_encoder), this measures:
+    frames encoded per second of wall time,
+    CPU seconds spent per second of audio encoded (including LAME's own
+        process, if it has one),
+    latency from the first add_pcm call until the first frame comes out,
+    and how long add_pcm blocks, and how much audio piles up, when PCM is
+        fed in faster than it can be encoded with a small safety_buffer.
+
+Each backend is fed one big NumPy array, and a renderable that gets
+rendered in chunks (like the mixer's actions are). Results are written
+as JSON.
+
+Usage: python lamebench.py [seconds of audio] [output.json]
+"""
+
+import os
+import sys
+import json
+import time
+import numpy
+import logging
+import traceback
+from lame import Lame
+from lamelib import LibLame
+
+log = logging.getLogger(__name__)
+
+BACKENDS = [('process', Lame), ('library', LibLame)]
+BACKPRESSURE_SAFETY_BUFFER = 1  # seconds
+
+
+def synthetic_pcm(seconds, samplerate=Lame.samplerate):
+    """A few seconds of noisy stereo tones - something for LAME to chew on."""
+    t = numpy.arange(int(seconds * samplerate)) / float(samplerate)
+    rs = numpy.random.RandomState(0)
+    left = numpy.sin(2 * numpy.pi * 440 * t) + 0.3 * rs.randn(len(t))
+    right = numpy.sin(2 * numpy.pi * 554.37 * t) + 0.3 * rs.randn(len(t))
+    pcm = numpy.column_stack((left, right)) * 8000
+    return numpy.clip(pcm, -32768, 32767).astype(numpy.int16)
+
+
+class Synthetic(object):
+    """Stands in for an action: renders the given PCM in chunks."""
+    def __init__(self, pcm):
+        self.pcm = pcm
+        self.samples = len(pcm)
+
+    def render(self, chunk_size):
+        for i in xrange(0, self.samples, chunk_size):
+            yield self.pcm[i:i + chunk_size]
+
+
+def cpu_time():
+    """CPU seconds used by us, and by any child processes we've waited for."""
+    user, system, child_user, child_system, _ = os.times()
+    return user + system + child_user + child_system
+
+
+def measure(backend, pieces, samples, safety_buffer=None):
+    frames = []
+
+    def callback(done):
+        if not done:
+            frames.append(time.time())
+
+    encoder = backend(callback=callback, safety_buffer=safety_buffer)
+    cpu = cpu_time()
+    encoder.start()
+
+    start = time.time()
+    waits = []
+    for piece in pieces:
+        put = time.time()
+        encoder.add_pcm(piece)
+        waits.append(time.time() - put)
+    returncode = encoder.finish()
+    elapsed = time.time() - start
+    cpu = cpu_time() - cpu
+
+    audio = samples / float(encoder.samplerate)
+    return {
+        "returncode": returncode,
+        "frames": len(frames),
+        "frames_per_second": len(frames) / elapsed,
+        "realtime_factor": audio / elapsed,
+        "cpu_per_second": cpu / audio,
+        "first_frame_latency": (frames[0] - start) if frames else None,
+        "max_add_pcm_wait": max(waits),
+        "total_add_pcm_wait": sum(waits),
+        "peak_buffered_seconds":
+            encoder.channel.peak / float(encoder.samplerate),
+    }
+
+
+def benchmark(seconds):
+    pcm = synthetic_pcm(seconds)
+    chunk = Lame.stream_chunk_size
+    inputs = [
+        ('array', lambda: [pcm], None),
+        ('render', lambda: [Synthetic(pcm)], None),
+        ('backpressure',
+         lambda: [pcm[i:i + chunk] for i in xrange(0, len(pcm), chunk)],
+         BACKPRESSURE_SAFETY_BUFFER),
+    ]
+
+    results = []
+    for name, backend in BACKENDS:
+        for kind, pieces, safety_buffer in inputs:
+            result = {"backend": name, "input": kind}
+            log.info("Encoding %ds of audio with %s backend, %s input...",
+                     seconds, name, kind)
+            try:
+                result.update(measure(backend, pieces(), len(pcm),
+                                      safety_buffer))
+            except Exception as e:
+                log.warning("Could not benchmark %s backend:\n%s",
+                            name, traceback.format_exc())
+                result["error"] = str(e)
+            results.append(result)
+    return {
+        "seconds": seconds,
+        "samplerate": Lame.samplerate,
+        "channels": Lame.channels,
+        "preset": Lame.preset,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    output = sys.argv[2] if len(sys.argv) > 2 else "lamebench.json"
+
+    report = benchmark(seconds)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for r in report['results']:
+        if 'error' in r:
+            print "%-8s %-13s %s" % (r['backend'], r['input'], r['error'])
+        else:
+            print "%-8s %-13s %7.1f frames/s %6.3f cpu/s %6.3fs latency " \
+                  "%6.3fs max wait %5.1fs peak buffered" % (
+                      r['backend'], r['input'], r['frames_per_second'],
+                      r['cpu_per_second'], r['first_frame_latency'] or 0,
+                      r['max_add_pcm_wait'], r['peak_buffered_seconds'])
+    print "Wrote %s." % output
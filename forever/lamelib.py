@@ -0,0 +1,151 @@
+"""
+lamelib.py
+
+Encodes MP3 in-process by calling libmp3lame through ctypes, rather than
+piping every sample through an external lame process and back. LibLame
+has the same interface as lame.Lame (add_pcm, oqueue, ofile, callback...)
+and only swaps out the encoder underneath, so the two can be compared
+like-for-like.
+
+Only the LAME command line options that we actually use are understood:
+-V (VBR quality), -b (bitrate), --cbr, --nores and -q (algorithm quality).
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import numpy
+from Queue import Queue
+from lame import Lame, FrameClock
+
+log = logging.getLogger(__name__)
+
+VBR_OFF = 0
+VBR_DEFAULT = 4
+
+_library = None
+
+
+def library():
+    """Load libmp3lame (once). Raises OSError if it can't be found."""
+    global _library
+    if _library is None:
+        path = ctypes.util.find_library('mp3lame')
+        if path is None:
+            raise OSError("libmp3lame is not installed.")
+        lib = ctypes.CDLL(path)
+
+        lib.lame_init.restype = ctypes.c_void_p
+        lib.lame_init.argtypes = []
+        for name in ('lame_set_in_samplerate', 'lame_set_num_channels',
+                     'lame_set_brate', 'lame_set_VBR', 'lame_set_VBR_q',
+                     'lame_set_quality', 'lame_set_bWriteVbrTag',
+                     'lame_set_disable_reservoir'):
+            getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.lame_init_params.argtypes = [ctypes.c_void_p]
+        lib.lame_get_encoder_delay.argtypes = [ctypes.c_void_p]
+        lib.lame_encode_buffer_interleaved.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_short), ctypes.c_int,
+            ctypes.c_char_p, ctypes.c_int
+        ]
+        lib.lame_encode_flush.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int
+        ]
+        lib.lame_close.argtypes = [ctypes.c_void_p]
+        _library = lib
+    return _library
+
+
+def mp3_buffer_size(samples):
+    """Worst case MP3 bytes for this many samples, as per lame.h."""
+    return int(1.25 * samples) + 7200
+
+
+class LibLame(Lame):
+    def spawn(self):
+        """Start the encoder - here, an in-process libmp3lame context."""
+        lib = library()
+        self.lib = lib
+        if self.lame:
+            #   Being restarted; the last context is no use to anybody.
+            lib.lame_close(self.lame)
+        self.lame = lib.lame_init()
+        if not self.lame:
+            raise MemoryError("lame_init failed.")
+        lib.lame_set_in_samplerate(self.lame, self.samplerate)
+        lib.lame_set_num_channels(self.lame, self.channels)
+        lib.lame_set_bWriteVbrTag(self.lame, 0)
+        self.configure(self.preset.split())
+        if lib.lame_init_params(self.lame) < 0:
+            raise ValueError("Could not use LAME options %r." % self.preset)
+        self.clock = FrameClock(lib.lame_get_encoder_delay(self.lame),
+                                self.samplerate)
+
+        self.__returncode = None
+        self.__output = Queue()
+        self.__buffer = ctypes.create_string_buffer(
+            mp3_buffer_size(self.stream_chunk_size))
+
+    def configure(self, options):
+        lib = self.lib
+        vbr = False
+        options = list(options)
+        while options:
+            option = options.pop(0)
+            if option.startswith('-V'):
+                quality = option[2:] or options.pop(0)
+                lib.lame_set_VBR(self.lame, VBR_DEFAULT)
+                lib.lame_set_VBR_q(self.lame, int(quality))
+                vbr = True
+            elif option == '-b':
+                lib.lame_set_brate(self.lame, int(options.pop(0)))
+                if not vbr:
+                    lib.lame_set_VBR(self.lame, VBR_OFF)
+            elif option == '--cbr':
+                lib.lame_set_VBR(self.lame, VBR_OFF)
+            elif option == '--nores':
+                lib.lame_set_disable_reservoir(self.lame, 1)
+            elif option == '-q':
+                lib.lame_set_quality(self.lame, int(options.pop(0)))
+            else:
+                log.warning("Ignoring unsupported LAME option %s.", option)
+
+    def write(self, data):
+        pcm = numpy.ascontiguousarray(data, dtype=numpy.int16)
+        samples = self.samples_in(pcm)
+        size = mp3_buffer_size(samples)
+        if len(self.__buffer) < size:
+            self.__buffer = ctypes.create_string_buffer(size)
+        written = self.lib.lame_encode_buffer_interleaved(
+            self.lame, pcm.ctypes.data_as(ctypes.POINTER(ctypes.c_short)),
+            samples, self.__buffer, size
+        )
+        if written < 0:
+            raise IOError("lame_encode_buffer_interleaved returned %d."
+                          % written)
+        if written:
+            self.__output.put(self.__buffer.raw[:written])
+
+    def read(self, size):
+        #   Whatever the encoder has produced - no need to wait for `size`.
+        return self.__output.get()
+
+    def close(self):
+        written = self.lib.lame_encode_flush(self.lame, self.__buffer,
+                                             len(self.__buffer))
+        if written > 0:
+            self.__output.put(self.__buffer.raw[:written])
+        self.__output.put('')
+        self.lib.lame_close(self.lame)
+        self.lame = None
+        self.__returncode = 0 if written >= 0 else written
+
+    def abort(self):
+        self.__output.put('')
+
+    def wait(self):
+        pass
+
+    @property
+    def returncode(self):
+        return self.__returncode
@@ -4,9 +4,13 @@ import Queue
 import config
 import logging
 from cube import emit
+from lame import FrameClock, SAMPLES_PER_FRAME, splice_point
 from restart import RESTART_EXIT_CODE
 
 LAG_LIMIT = config.lag_limit
+JOIN_WAIT = config.get('join_wait', 1.0)
+#   Only the splice_safe profile reliably has clean frames to start on.
+SPLICE_SAFE = config.get('encoder_profile', 'vbr') == 'splice_safe'
 log = logging.getLogger(config.log_name)
 log.setLevel(logging.DEBUG)
 
@@ -20,9 +24,16 @@ class Listeners(list):
         self.__count = 0L
         self.__drift_limit = config.drift_limit
         self.__semaphore = semaphore
+        self.__clock = FrameClock()
+        #   New listeners, waiting for a frame that they can start on.
+        self.__joining = []
+        self.__since_splice = 0
         list.__init__(self)
 
     def append(self, listener):
+        if self.__packet and SPLICE_SAFE and not splice_point(self.__packet):
+            self.__joining.append(listener)
+            return
         if self.__packet:
             listener.write(self.__packet)
             listener.flush()
@@ -39,8 +50,8 @@ class Listeners(list):
 
             uptime = float(now - self.__first_send)
             if self.__count > 0 and not self.__count % 30:
-                samples = self.__count * 1152
-                duration = float(self.__count) * 1152.0 / 44100.0
+                samples = self.__count * SAMPLES_PER_FRAME
+                duration = self.__clock.seconds(self.__count)
                 buffered = self.queue.buffered
                 emit('drift', {
                     'ms': (duration - uptime) * 1000.0,
@@ -55,13 +66,11 @@ class Listeners(list):
                             self.__count, samples, duration, uptime,
                             duration / uptime)
 
-            if (float(self.__count) * 1152.0 / 44100.0) \
-                    + self.__drift_limit < uptime:
+            played = self.__clock.seconds(self.__count)
+            if played + self.__drift_limit < uptime:
                 log.warning("Queue %s drifting by %2.2f ms. Compensating...",
-                    self.__name,
-                    1000 * (uptime - (float(self.__count) * 1152.0 / 44100.0))
-                )
-                while (float(self.__count) * 1152.0 / 44100.0) < uptime:
+                    self.__name, 1000 * (uptime - played))
+                while self.__clock.seconds(self.__count) < uptime:
                     self.__broadcast()
         except Queue.Empty:
             if self.__packet and not self.__starving:
@@ -74,6 +83,16 @@ class Listeners(list):
         self.__packet = self.queue.get_nowait()
         self.__count += 1
         self.__starving = False
+        if splice_point(self.__packet):
+            self.__since_splice = 0
+        else:
+            self.__since_splice += 1
+        if self.__joining and (not self.__since_splice or
+                self.__clock.seconds(self.__since_splice) > JOIN_WAIT):
+            #   Start new listeners on a frame that decodes cleanly, unless
+            #   the stream doesn't have any to offer.
+            self.extend(self.__joining)
+            self.__joining = []
         for i, listener in enumerate(list(self)):
             if listener.request.connection.stream.closed():
                 try:
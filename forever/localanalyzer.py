@@ -0,0 +1,147 @@
+"""
+localanalyzer.py
+
+A crude, local stand-in for the Echo Nest analyzer, so that the mixer can
+run without any network access (i.e.: in test rigs). It produces a
+CompactAnalysis from decoded PCM: a tempo from the autocorrelation of an
+onset envelope, a regular beat grid, and per-tatum segments with
+band-energy "timbre" and chroma "pitches".
+
+This is nowhere near as good as a real analysis - but it's good enough
+to beatmatch with.
+"""
+
+import sys
+import numpy
+from compactanalysis import CompactAnalysis
+
+HOP = 512                   # samples per onset envelope frame
+MIN_BPM, MAX_BPM = 70, 170
+TATUMS_PER_BEAT = 2
+BEATS_PER_BAR = 4
+BARS_PER_SECTION = 16
+MAX_FFT = 4096
+
+
+def mono(track):
+    pcm = getattr(track, 'pcm', None)
+    if pcm is not None:
+        pcm.wait_for(sys.maxint)
+        data = pcm.data
+    else:
+        data = track.data
+    data = numpy.asarray(data, dtype=numpy.float32) / 32768.0
+    return data.mean(axis=1) if data.ndim == 2 else data
+
+
+def onset_envelope(signal):
+    frames = len(signal) / HOP
+    energy = numpy.sqrt(numpy.mean(
+        signal[:frames * HOP].reshape(frames, HOP) ** 2, axis=1))
+    return numpy.maximum(numpy.diff(numpy.log(energy + 1e-6)), 0)
+
+
+def find_beat(envelope, samplerate):
+    """Returns (period, phase) of the beat grid, in seconds."""
+    frame = float(HOP) / samplerate
+    lags = numpy.arange(int(60.0 / MAX_BPM / frame),
+                        int(60.0 / MIN_BPM / frame) + 1)
+    lags = lags[lags < len(envelope)]
+    if not len(lags):
+        return 0.5, 0.0
+    scores = [numpy.dot(envelope[:-lag], envelope[lag:]) for lag in lags]
+    lag = lags[int(numpy.argmax(scores))]
+    phases = [envelope[p::lag].sum() for p in xrange(lag)]
+    return lag * frame, int(numpy.argmax(phases)) * frame
+
+
+def grid(start, period, end):
+    starts = numpy.arange(start, end - period, period)
+    return {
+        'start': starts,
+        'duration': numpy.ones(len(starts)) * period,
+        'confidence': numpy.ones(len(starts)),
+    }
+
+
+def band_edges(n):
+    """Log-spaced edges of 12 frequency bands over an n-bin spectrum."""
+    return numpy.unique(numpy.logspace(0, numpy.log10(n), 13).astype(int))
+
+
+def describe(signal, samplerate):
+    """Timbre-like band energies and chroma for one segment of audio."""
+    spectrum = numpy.abs(numpy.fft.rfft(signal[:MAX_FFT], MAX_FFT))
+    timbre = numpy.zeros(12)
+    edges = band_edges(len(spectrum))
+    for i, (lo, hi) in enumerate(zip(edges, edges[1:])[:12]):
+        timbre[i] = numpy.log(spectrum[lo:hi].sum() + 1e-6)
+
+    freqs = numpy.arange(len(spectrum)) * samplerate / float(MAX_FFT)
+    audible = (freqs > 27.5) & (freqs < 4200)
+    classes = numpy.round(12 * numpy.log2(freqs[audible] / 440.0)) % 12
+    pitches = numpy.bincount(classes.astype(int),
+                             weights=spectrum[audible], minlength=12)[:12]
+    if pitches.max() > 0:
+        pitches /= pitches.max()
+    return timbre, pitches
+
+
+def analyze(track, md5=None):
+    samplerate = track.sampleRate
+    signal = mono(track)
+    duration = len(signal) / float(samplerate)
+    rms = float(numpy.sqrt(numpy.mean(signal ** 2))) if len(signal) else 0.0
+    loudness = float(20 * numpy.log10(rms + 1e-6))
+
+    period, phase = find_beat(onset_envelope(signal), samplerate)
+    period, phase = float(period), float(phase)
+    tempo = 60.0 / period
+
+    beats = grid(phase, period, duration)
+    tatums = grid(phase, period / TATUMS_PER_BEAT, duration)
+    bars = grid(phase, period * BEATS_PER_BAR, duration)
+    sections = grid(phase, period * BEATS_PER_BAR * BARS_PER_SECTION,
+                    duration)
+
+    segments = grid(0, period / TATUMS_PER_BEAT, duration)
+    n = len(segments['start'])
+    segments['timbre'] = numpy.zeros((n, 12))
+    segments['pitches'] = numpy.zeros((n, 12))
+    segments['loudness_max'] = numpy.zeros(n)
+    for i, (start, length) in enumerate(zip(segments['start'],
+                                            segments['duration'])):
+        s = int(start * samplerate)
+        chunk = signal[s:s + int(length * samplerate)]
+        segments['timbre'][i], segments['pitches'][i] = \
+            describe(chunk, samplerate)
+        segments['loudness_max'][i] = \
+            20 * numpy.log10(numpy.abs(chunk).max() + 1e-6)
+
+    fields = {
+        'duration': duration,
+        'loudness': loudness,
+        'tempo': {'value': tempo, 'confidence': 0.5},
+        'time_signature': {'value': BEATS_PER_BAR, 'confidence': 0.5},
+        'end_of_fade_in': 0.0,
+        'start_of_fade_out': duration,
+    }
+    summary = {
+        'audio_md5': md5,
+        'duration': duration,
+        'key': 0,
+        'mode': 1,
+        'time_signature': BEATS_PER_BAR,
+        'danceability': 0.5,
+        'energy': min(rms * 4, 1.0),
+        'loudness': loudness,
+        'tempo': tempo,
+        'echoprintstring': md5 or '',
+    }
+    return CompactAnalysis(fields, summary, {
+        'sections': sections,
+        'bars': bars,
+        'beats': beats,
+        'tatums': tatums,
+        'segments': segments,
+    })
@@ -0,0 +1,84 @@
+"""
+memory.py
+
+Rough per-track memory accounting for the mixer: decoded PCM, the
+analysis object graph and the resampled feature matrices.
+"""
+
+import sys
+import numpy
+import weakref
+
+
+def sizeof(obj, seen=None):
+    """
+    Approximate deep size of an object graph in bytes. Follows lists,
+    tuples, dicts and instance attributes, counts numpy arrays by their
+    buffers and never follows weak references.
+    """
+    if seen is None:
+        seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, weakref.ref):
+            continue
+        seen.add(id(o))
+        if isinstance(o, numpy.ndarray):
+            total += o.nbytes if o.base is None else 0
+            continue
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        if hasattr(o, '__dict__'):
+            stack.append(o.__dict__)
+    return total
+
+
+def pcm_bytes(track):
+    """
+    Bytes of decoded audio that the track still holds - i.e.: not counting
+    anything released with remove_upto, or room a PCMBuffer has spare.
+    """
+    pcm = getattr(track, 'pcm', None)
+    if pcm is not None:
+        return pcm.data.nbytes  # a view over just the live region
+    data = getattr(track, 'data', None)
+    if isinstance(data, numpy.ndarray):
+        return data.nbytes
+    return 0
+
+
+def analysis_bytes(track):
+    """
+    Size of the track's analysis, cached on the track as the analysis is
+    never modified after the track has been processed.
+    """
+    if not hasattr(track, 'analysis'):
+        return 0
+    if getattr(track, '_analysis_bytes', None) is None:
+        #   Don't count the track (and its PCM) through analysis.source.
+        track._analysis_bytes = sizeof(track.analysis,
+                                       set([id(track), id(track.data)]))
+    return track._analysis_bytes
+
+
+def resampled_bytes(track):
+    resampled = getattr(track, 'resampled', None) or {}
+    return sum(getattr(v, 'nbytes', 0) for v in resampled.itervalues())
+
+
+def track_memory(track):
+    usage = {
+        'pcm': pcm_bytes(track),
+        'analysis': analysis_bytes(track),
+        'resampled': resampled_bytes(track),
+    }
+    usage['total'] = sum(usage.values())
+    metadata = getattr(track, '_metadata', None)
+    usage['id'] = getattr(metadata, 'id', None)
+    usage['title'] = getattr(metadata, 'title', None)
+    return usage
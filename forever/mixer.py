@@ -4,26 +4,40 @@ Heavily modified by Peter Sobot for integration with forever.fm.
 """
 import os
 import gc
+import time
+import config
 import apikeys
 import logging
+import weakref
 import urllib2
 import traceback
 import threading
 import multiprocessing
 
-from lame import Lame
+from lame import Lame, PROFILES
+from lamelib import LibLame
+from fanout import Fanout
 from timer import Timer
+from cube import emit
+from memory import track_memory
 from database import Database, merge
 
-from echonest.audio import LocalAudioStream
-from audio import AudioData
+from audio import AudioData, LocalAudioFile
+from action import Crossmatch
+from stretcher import ParallelStretcher
+from renderahead import RenderAhead
+from compactanalysis import CompactAnalysis
 
-from capsule_support import order_tracks, resample_features, \
-                            timbre_whiten, initialize, make_transition, terminate, \
-                            FADE_OUT, is_valid, LOUDNESS_THRESH
+from capsule_support import order_tracks, analysis_arrays, resample_whitened, \
+                            initialize, make_transition, terminate, \
+                            MarkerIndex, FADE_OUT, is_valid, LOUDNESS_THRESH
 
 log = logging.getLogger(__name__)
 
+RESAMPLE_TIMEOUT = 60   # seconds to wait on the analysis pool before giving up
+BUDGET_POLL = 1         # seconds between memory checks while over budget
+BUDGET_WAIT = 60        # maximum seconds to defer fetching the next track
+
 import sys
 test = 'test' in sys.argv
 
@@ -69,11 +83,13 @@ class Mixer(multiprocessing.Process):
     def __init__(self, iqueue, oqueues, infoqueue,
                  settings=({},), initial=None,
                  max_play_time=300, transition_time=30 if not test else 5,
-                 samplerate=44100):
+                 samplerate=44100, statsqueue=None):
         self.iqueue = iqueue
         self.infoqueue = infoqueue
+        self.statsqueue = statsqueue
 
         self.encoders = []
+        self.output = None  # the Fanout that actions are rendered into
         if len(oqueues) != len(settings):
             raise ValueError("Differing number of output queues and settings!")
 
@@ -83,6 +99,9 @@ class Mixer(multiprocessing.Process):
         self.__track_lock = threading.Lock()
         self.__tracks = []
 
+        self.__pool = None
+        self.__pool_pid = None
+
         self.max_play_time = max_play_time
         self.transition_time = transition_time
         self.samplerate = 44100
@@ -112,6 +131,28 @@ class Mixer(multiprocessing.Process):
     def current_track(self):
         return self.tracks[0]
 
+    @property
+    def pool(self):
+        """
+        Worker processes for feature extraction, so that resampling never
+        competes with rendering and encoding for this process's CPU time.
+        Created lazily, as a pool can't survive the fork into run().
+        """
+        if self.__pool is None or self.__pool_pid != os.getpid():
+            self.__pool = multiprocessing.Pool(config.analysis_workers)
+            self.__pool_pid = os.getpid()
+        return self.__pool
+
+    def resample(self, track, rate='beats'):
+        arrays = analysis_arrays(track.analysis, rate)
+        try:
+            return self.pool.apply_async(resample_whitened, (arrays, rate))\
+                            .get(RESAMPLE_TIMEOUT)
+        except Exception:
+            log.warning("Could not resample in analysis pool:\n%s",
+                        traceback.format_exc())
+            return resample_whitened(arrays, rate)
+
     def get_stream(self, x):
         fname = os.path.abspath("cache/%d.mp3" % x.id)
         if os.path.isfile(fname):
@@ -143,7 +184,8 @@ class Mixer(multiprocessing.Process):
             return self.analyze(*x)
 
         log.info("Grabbing stream...", uid=x.id)
-        laf = LocalAudioStream(self.get_stream(x))
+        with open(self.get_stream(x), 'rb') as f:
+            laf = LocalAudioFile(f)
         setattr(laf, "_metadata", x)
         Database().ensure(merge(x, laf.analysis))
         return self.process(laf)
@@ -155,22 +197,101 @@ class Mixer(multiprocessing.Process):
         self.tracks += order_tracks(self.analyze(tracks))
 
     def process(self, track):
-        if not hasattr(track.analysis.pyechonest_track, "title"):
-            setattr(track.analysis.pyechonest_track, "title", track._metadata.title)
-        log.info("Resampling features...", uid=track._metadata.id)
-        track.resampled = resample_features(track, rate='beats')
-        track.resampled['matrix'] = timbre_whiten(track.resampled['matrix'])
-
-        if not is_valid(track, self.transition_time):
-            raise ValueError("Track too short!")
-
-        track.gain = self.__db_2_volume(track.analysis.loudness)
-        log.info("Done processing.", uid=track._metadata.id)
-        return track
+        try:
+            if not hasattr(track.analysis.pyechonest_track, "title"):
+                setattr(track.analysis.pyechonest_track, "title", track._metadata.title)
+            if not isinstance(track.analysis, CompactAnalysis):
+                track.analysis = CompactAnalysis.from_analysis(track.analysis)
+                track.analysis.source = weakref.ref(track)
+            log.info("Resampling features...", uid=track._metadata.id)
+            track.resampled = self.resample(track, rate='beats')
+            track.resampled['markers'] = MarkerIndex.of(track)
+
+            if not is_valid(track, self.transition_time):
+                raise ValueError("Track too short!")
+
+            track.gain = self.__db_2_volume(track.analysis.loudness)
+            log.info("Done processing.", uid=track._metadata.id)
+            return track
+        except Exception:
+            #   Don't leave the track decoding in the background.
+            track.finish()
+            raise
 
     def __db_2_volume(self, loudness):
         return (1.0 - LOUDNESS_THRESH * (LOUDNESS_THRESH - loudness) / 100.0)
 
+    @property
+    def memory_budget(self):
+        return config.mixer_memory_budget * 1024 * 1024
+
+    def memory(self):
+        """Publish and return the memory held by each queued track."""
+        tracks = [track_memory(t) for t in self.tracks]
+        usage = {
+            'tracks': tracks,
+            'total': sum(t['total'] for t in tracks),
+            'budget': self.memory_budget,
+        }
+        emit('mixer_memory', {'total': usage['total'],
+                              'tracks': len(tracks)})
+        if self.statsqueue is not None:
+            self.statsqueue.put(usage)
+        return usage
+
+    def release_head(self, track):
+        """
+        Throw away the decoded audio before the first sample that any action
+        we've handed out will ask for. For a track that was mixed in at its
+        center, this is everything before the transition into it.
+        """
+        entry = getattr(track, 'entry', None)
+        if entry is None:
+            return
+        #   Render-ahead may be slicing this track right now - don't let the
+        #   offset move between reading it and removing up to it.
+        with track.lock:
+            sample = int(entry * track.sampleRate) - track.offset
+            if sample > 0:
+                log.info("Releasing %d samples of unplayed audio.", sample,
+                         uid=track._metadata.id)
+                track.remove_upto(sample)
+
+    def enforce_budget(self, release=(), defer=False):
+        """
+        Keep the tracks we're holding under config.mixer_memory_budget, by
+        releasing the unplayed heads of the tracks in `release` and then, if
+        that's not enough and `defer` is set, by waiting for rendering to
+        drain memory before we fetch the next track.
+
+        Only pass tracks in `release` that the encoder isn't reading from yet.
+        """
+        usage = self.memory()
+        if usage['total'] <= usage['budget']:
+            return
+        log.warning("Mixer is over its memory budget (%d > %d bytes).",
+                    usage['total'], usage['budget'])
+        for track in release:
+            self.release_head(track)
+        gc.collect()
+
+        deadline = time.time() + BUDGET_WAIT
+        usage = self.memory()
+        while defer and usage['total'] > usage['budget'] \
+                and time.time() < deadline:
+            time.sleep(BUDGET_POLL)
+            usage = self.memory()
+        if usage['total'] > usage['budget']:
+            log.warning("Still over memory budget (%d > %d bytes).",
+                        usage['total'], usage['budget'])
+
+    def render_ahead(self, action):
+        """Start rendering action (i.e.: a transition) in the background."""
+        seconds = config.render_ahead
+        if seconds > 0:
+            RenderAhead(action, Lame.stream_chunk_size,
+                        seconds * self.samplerate).start()
+
     def loop(self):
         while len(self.tracks) < 2:
             log.info("Waiting for a new track.")
@@ -195,13 +316,26 @@ class Mixer(multiprocessing.Process):
                 tra = make_transition(self.tracks[0],
                                       self.tracks[1],
                                       stay_time,
-                                      self.transition_time)
+                                      self.transition_time,
+                                      config.get('transition_candidates', 1),
+                                      config.get('transition_window', 0))
+                #   The transition itself is always second-last: it may be
+                #   preceded by some more playback of the outgoing track.
+                self.tracks[1].entry = getattr(tra[-2], 's2', None)
+                self.render_ahead(tra[-2])
                 del self.tracks[0].analysis
                 gc.collect()
+                self.enforce_budget(release=[self.tracks[1]])
                 yield tra
+                #   The encoder could still be rendering from this track -
+                #   but not in the last action, which only plays the next
+                #   one. Plan the next transition while that plays.
+                if self.output is not None:
+                    self.output.drain(1)
                 self.tracks[0].finish()
                 del self.tracks[0]
                 gc.collect()
+            self.enforce_budget(defer=True)
             log.info("Waiting for a new track.")
             try:
                 self.add_track(self.iqueue.get())  # TODO: Allow multiple tracks.
@@ -216,11 +350,43 @@ class Mixer(multiprocessing.Process):
         # Last chunk. Should contain 1 instruction: fadeout.
         yield terminate(self.tracks[-1], FADE_OUT)
 
+    def start_encoder(self, oqueue, settings, syncqueue=None):
+        settings = dict(settings)
+        profile = PROFILES[config.get('encoder_profile', 'vbr')]
+        settings.setdefault('preset', profile % {
+            'bitrate': config.get('encoder_bitrate', 128)})
+        settings.setdefault('safety_buffer',
+                            config.get('encoder_buffer', Lame.safety_buffer))
+        settings.setdefault('stall_timeout',
+                            config.get('encoder_stall_timeout',
+                                       Lame.stall_timeout))
+        if config.get('encoder_backend', 'process') == 'library':
+            try:
+                e = LibLame(oqueue=oqueue, syncqueue=syncqueue, **settings)
+                e.start()
+                return e
+            except Exception:
+                log.error("Could not start in-process encoder, "
+                          "falling back to LAME process:\n%s",
+                          traceback.format_exc())
+        e = Lame(oqueue=oqueue, syncqueue=syncqueue, **settings)
+        e.start()
+        return e
+
     def run(self):
+        if config.stretch_workers > 1:
+            Crossmatch.stretcher = ParallelStretcher(config.stretch_workers)
+
+        #   The first encoder passes each action's metadata on to the info
+        #   queue once the action's first frame has been encoded.
+        syncqueue = self.infoqueue
         for oqueue, settings in zip(self.oqueues, self.settings):
-            e = Lame(oqueue=oqueue, **settings)
-            self.encoders.append(e)
-            e.start()
+            self.encoders.append(self.start_encoder(oqueue, settings,
+                                                    syncqueue))
+            syncqueue = None
+        self.output = Fanout(self.encoders, Lame.stream_chunk_size,
+                             config.get('encoder_backlog', 10)
+                             * self.samplerate)
 
         try:
             self.ctime = None
@@ -229,11 +395,7 @@ class Mixer(multiprocessing.Process):
                 for a in actions:
                     try:
                         with Timer() as t:
-                            #   TODO: Move the "multiple encoding" support into
-                            #   LAME itself - it should be able to multiplex the
-                            #   streams itself.
-                            self.encoders[0].add_pcm(a)
-                            self.infoqueue.put(generate_metadata(a))
+                            self.output.add_pcm(a, generate_metadata(a))
                         log.info("Rendered in %fs!", t.ms)
                     except:
                         log.error("Could not render %s. Skipping.\n%s", a,
@@ -0,0 +1,165 @@
+"""
+mixing.py
+
+In-place mixing kernels: gain, fade envelopes, linear and equal-power
+crossfades, and limiting. Each kernel does its arithmetic in float32
+scratch buffers that are allocated once and reused, and writes its int16
+result into an output array supplied by the caller - so once warmed up,
+rendering a chunk of audio doesn't allocate anything.
+
+Scratch buffers are not thread-safe; use one Scratch per renderer.
+
+The same goes for renderers' output: a chunk that a renderer yields is only
+valid until the next one is asked for (it may be a view of a reused buffer,
+or of a track's PCM). Anything that holds on to chunks copies them with
+keep() - nowhere else.
+"""
+
+import numpy
+
+INT16_MIN, INT16_MAX = -32768, 32767
+
+
+class Scratch(object):
+    """Named float32 working buffers, grown as needed and then reused."""
+    def __init__(self):
+        self.buffers = {}
+        self.steps = numpy.zeros(0, dtype=numpy.float32)
+
+    def get(self, shape, name='mix'):
+        if isinstance(shape, int):
+            shape = (shape,)
+        size = int(numpy.prod(shape))
+        buf = self.buffers.get(name)
+        if buf is None or len(buf) < size:
+            buf = self.buffers[name] = numpy.empty(size, dtype=numpy.float32)
+        return buf[:size].reshape(shape)
+
+    def ramp(self, n, start, end, name='ramp'):
+        """n volumes, from start up to (but not including) end."""
+        if len(self.steps) < n:
+            self.steps = numpy.arange(n, dtype=numpy.float32)
+        env = self.get(n, name)
+        numpy.multiply(self.steps[:n], numpy.float32(float(end - start) / n),
+                       out=env)
+        env += numpy.float32(start)
+        return env
+
+
+def keep(chunk):
+    """A copy of a rendered chunk that stays valid for as long as needed."""
+    return numpy.array(chunk)
+
+
+def channels(env, data):
+    """Shape a per-sample envelope to multiply against data."""
+    return env[:, numpy.newaxis] if data.ndim == 2 else env
+
+
+def limit(buf, out, knee=1.0, scratch=None):
+    """
+    Clip float samples in buf (in place) to the int16 range and write them
+    to out. With knee < 1, samples beyond knee * full scale are compressed
+    smoothly into the remaining headroom (with tanh) rather than clipped.
+    """
+    if knee < 1.0:
+        threshold = knee * INT16_MAX
+        headroom = INT16_MAX - threshold
+        excess = scratch.get(buf.shape, 'limit') if scratch is not None \
+            else numpy.empty_like(buf)
+        numpy.abs(buf, out=excess)
+        excess -= numpy.float32(threshold)
+        numpy.maximum(excess, 0, out=excess)
+        numpy.copysign(excess, buf, out=excess)
+        buf -= excess
+        excess *= numpy.float32(1.0 / headroom)
+        numpy.tanh(excess, out=excess)
+        excess *= numpy.float32(headroom)
+        buf += excess
+    numpy.clip(buf, INT16_MIN, INT16_MAX, out=buf)
+    out[...] = buf
+    return out
+
+
+def gain(data, volume, out, scratch, knee=1.0):
+    """out = data * volume."""
+    buf = scratch.get(data.shape)
+    numpy.multiply(data, numpy.float32(volume), out=buf)
+    return limit(buf, out, knee, scratch)
+
+
+def fade(data, volume, start, end, out, scratch, knee=1.0):
+    """out = data * volume, ramped linearly from start to end across data."""
+    buf = scratch.get(data.shape)
+    env = scratch.ramp(len(data), start * volume, end * volume)
+    numpy.multiply(data, channels(env, data), out=buf)
+    return limit(buf, out, knee, scratch)
+
+
+def crossfade(d1, d2, out, scratch, mode='linear', total=None, offset=0,
+              knee=1.0):
+    """
+    Crossfade from d1 to d2. The fade runs over `total` samples, of which
+    these are the len(d1) starting `offset` samples in, so that a long
+    crossfade can be rendered in chunks. Linear fades keep amplitude
+    constant; equal_power fades keep power constant.
+    """
+    n = len(d1)
+    if total is None:
+        total = n
+    fin = scratch.ramp(n, float(offset) / total, float(offset + n) / total)
+    fout = scratch.get(n, 'fadeout')
+    numpy.subtract(numpy.float32(1.0), fin, out=fout)
+    if mode == 'equal_power':
+        numpy.sqrt(fin, out=fin)
+        numpy.sqrt(fout, out=fout)
+
+    buf = scratch.get(d1.shape)
+    other = scratch.get(d2.shape, 'other')
+    numpy.multiply(d1, channels(fout, d1), out=buf)
+    numpy.multiply(d2, channels(fin, d2), out=other)
+    buf += other
+    return limit(buf, out, knee, scratch)
+
+
+if __name__ == "__main__":
+    import time
+    from numpy import multiply, float32
+
+    def bench(name, f, repeat=200):
+        f()
+        start = time.time()
+        for _ in xrange(repeat):
+            f()
+        print "%-28s %8.1fus" % (name, (time.time() - start) / repeat * 1e6)
+
+    n = 44100 / 8
+    rs = numpy.random.RandomState(0)
+    a = (rs.randn(n, 2) * 12000).astype(numpy.int16)
+    b = (rs.randn(n, 2) * 12000).astype(numpy.int16)
+    out = numpy.empty_like(a)
+    scratch = Scratch()
+
+    print "Mixing %d stereo samples at a time:" % n
+    bench("numpy gain", lambda: numpy.clip(
+          multiply(a, float32(0.8)), INT16_MIN, INT16_MAX).astype(numpy.int16))
+    bench("kernel gain", lambda: gain(a, 0.8, out, scratch))
+    bench("kernel gain (soft)", lambda: gain(a, 0.8, out, scratch, 0.9))
+    bench("kernel fade", lambda: fade(a, 0.8, 1.0, 0.5, out, scratch))
+    bench("kernel crossfade", lambda: crossfade(a, b, out, scratch))
+    bench("kernel crossfade (power)",
+          lambda: crossfade(a, b, out, scratch, 'equal_power'))
+
+    try:
+        import cAction
+    except ImportError:
+        print "cAction is not available; skipping its benchmarks."
+    else:
+        bench("cAction gain", lambda: cAction.limit(
+              multiply(a, float32(0.8))).astype(numpy.int16))
+        bench("cAction fade", lambda: cAction.fade(
+              a, 0.8, 1.0, 0.5).astype(numpy.int16))
+        bench("cAction crossfade", lambda: cAction.crossfade(
+              a, b, 'linear', n, 0).astype(numpy.int16))
+        bench("cAction crossfade (power)", lambda: cAction.crossfade(
+              a, b, 'equal_power', n, 0).astype(numpy.int16))
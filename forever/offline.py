@@ -0,0 +1,130 @@
+"""
+offline.py
+
+Renders a whole mix straight to an MP3 file, as fast as the machine allows,
+without running the server - for regression-testing transitions, or for
+producing a pre-rendered mix. Tracks go through exactly the same
+Mixer.process/make_transition/action rendering as they do live; beats are
+time-stretched on every core, and nothing waits on real time.
+
+Usage: python offline.py output.mp3 track track [track ...]
+    where each track is a SoundCloud track ID or a path to an audio file.
+"""
+
+import os
+import sys
+import time
+import apikeys
+import customlog
+import logging
+import multiprocessing
+import pyechonest.config
+from collections import deque
+from soundcloud.resource import Resource
+
+from lame import Lame
+from mixer import Mixer
+from timer import Timer
+from fanout import Fanout
+from metadata import Metadata
+from action import Crossmatch
+from audio import LocalAudioFile
+from stretcher import ParallelStretcher
+
+pyechonest.config.ECHO_NEST_API_KEY = apikeys.ECHO_NEST_API_KEY
+
+log = logging.getLogger(__name__)
+
+
+class Playlist(object):
+    """Stands in for the mixer's input queue. None means no more tracks."""
+    def __init__(self, tracks):
+        self.tracks = deque(tracks)
+
+    def get(self):
+        if self.tracks:
+            return self.tracks.popleft()
+        return None
+
+
+def local_metadata(path):
+    """Just enough SoundCloud-style metadata for a local file."""
+    return Resource({
+        'id': os.path.basename(path),
+        'title': os.path.splitext(os.path.basename(path))[0],
+    })
+
+
+class OfflineMixer(Mixer):
+    """
+    A Mixer that plays through a fixed list of tracks, in order, then
+    fades out - and that renders in this process, rather than as one.
+    """
+    def __init__(self, tracks, **kwargs):
+        if len(tracks) < 2:
+            raise ValueError("Need at least two tracks to mix!")
+        self.playlist = Playlist(tracks[2:])
+        Mixer.__init__(self, self.playlist, (None,), None, **kwargs)
+        #   Load the first two up front, so that a bad one fails right away
+        #   rather than leaving loop() waiting for more.
+        for track in tracks[:2]:
+            Mixer.add_track(self, track)
+
+    def analyze(self, x):
+        if isinstance(x, basestring):
+            log.info("Opening %s...", x)
+            kind = os.path.splitext(x)[1][1:].lower() or "mp3"
+            with open(x, 'rb') as f:
+                laf = LocalAudioFile(f, kind=kind)
+            setattr(laf, "_metadata", local_metadata(x))
+            return self.process(laf)
+        return Mixer.analyze(self, x)
+
+    def add_track(self, track):
+        if track is None:
+            #   End of the playlist: loop() will fade out the last track.
+            self.stop()
+        else:
+            Mixer.add_track(self, track)
+
+    def render(self, ofile):
+        """Encode the whole mix to ofile. Returns seconds of audio rendered."""
+        Crossmatch.stretcher = ParallelStretcher(multiprocessing.cpu_count())
+        encoder = self.start_encoder(None, {'ofile': ofile})
+        #   loop() drains this before it lets go of each finished track.
+        self.output = Fanout([encoder], Lame.stream_chunk_size, 0)
+        for actions in self.loop():
+            for a in actions:
+                with Timer() as t:
+                    self.output.add_pcm(a)
+                log.info("Queued %s (%2.2fs of audio) in %2.2fms.",
+                         a, a.duration, t.ms)
+        self.output.finish()
+        encoder.finish()
+        return encoder.written / float(self.samplerate)
+
+
+def track(arg):
+    """A local file, or the SoundCloud track with this ID."""
+    if os.path.exists(arg):
+        return arg
+    return Metadata.client.get('/tracks/%d' % int(arg))
+
+
+if __name__ == "__main__":
+    for handler in logging.root.handlers:
+        logging.root.removeHandler(handler)
+    logging.root.addHandler(customlog.MultiprocessingStreamHandler())
+
+    if len(sys.argv) < 4:
+        print __doc__
+        sys.exit(1)
+
+    start = time.time()
+    mixer = OfflineMixer([track(arg) for arg in sys.argv[2:]])
+    with open(sys.argv[1], 'wb') as f:
+        duration = mixer.render(f)
+    elapsed = time.time() - start
+
+    print "Rendered %2.2fs of audio to %s in %2.2fs (%2.2fx real time)." % (
+        duration, sys.argv[1], elapsed, duration / elapsed)
@@ -0,0 +1,133 @@
+"""
+pcmbuffer.py
+by Peter Sobot
+
+Growable, thread-safe PCM buffer that one thread can fill (i.e.: from an
+ffmpeg pipe) while other threads slice out of it. Indices are absolute
+sample numbers from the start of the stream - readers block until the
+range they've asked for has been written, or until the writer finishes.
+"""
+
+import numpy
+import threading
+
+GROWTH_FACTOR = 1.5
+
+
+class PCMBuffer(object):
+    def __init__(self, capacity, channels=2, dtype=numpy.int16):
+        self.channels = channels
+        self.dtype = dtype
+        self.__data = numpy.zeros(self.__shape(max(int(capacity), 1)),
+                                  dtype=dtype)
+        self.__lock = threading.Condition()
+
+        #   Absolute sample indices of the live region [start, end).
+        self.start = 0
+        self.end = 0
+        self.finished = False
+        self.error = None
+
+    def __shape(self, samples):
+        if self.channels == 1:
+            return (samples,)
+        return (samples, self.channels)
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def capacity(self):
+        return len(self.__data)
+
+    @property
+    def nbytes(self):
+        return self.__data.nbytes
+
+    @property
+    def data(self):
+        """A view over the live (written and not yet discarded) region."""
+        return self.__data[0:self.end - self.start]
+
+    def __reserve(self, samples):
+        """
+        Make room for `samples` more samples, without reallocating if we can
+        get away with it. Must be called with the lock held.
+        """
+        live = self.end - self.start
+        if live + samples <= len(self.__data):
+            return
+        capacity = len(self.__data)
+        while capacity < live + samples:
+            capacity = int(capacity * GROWTH_FACTOR) + 1
+        data = numpy.zeros(self.__shape(capacity), dtype=self.dtype)
+        data[0:live] = self.__data[0:live]
+        self.__data = data
+
+    def write(self, chunk):
+        """Append a chunk of samples to the end of the buffer."""
+        samples = len(chunk)
+        if not samples:
+            return
+        with self.__lock:
+            self.__reserve(samples)
+            live = self.end - self.start
+            self.__data[live:live + samples] = chunk
+            self.end += samples
+            self.__lock.notify_all()
+
+    def finish(self, error=None):
+        """Mark the stream as complete. Wakes up every waiting reader."""
+        with self.__lock:
+            self.finished = True
+            self.error = error
+            self.__lock.notify_all()
+
+    def wait_for(self, sample, timeout=None):
+        """
+        Block until `sample` samples have been written to the buffer, or
+        until the writer has finished. Returns the number of samples
+        available at that point.
+        """
+        with self.__lock:
+            while self.end < sample and not self.finished:
+                self.__lock.wait(timeout)
+            if self.error is not None:
+                raise self.error
+            return self.end
+
+    def slice(self, start, stop):
+        """
+        Copy out the samples between absolute indices `start` and `stop`.
+        Like a numpy slice, out-of-range indices are truncated.
+        """
+        self.wait_for(stop)
+        with self.__lock:
+            s = min(max(start - self.start, 0), self.end - self.start)
+            e = min(max(stop - self.start, s), self.end - self.start)
+            return numpy.array(self.__data[s:e])
+
+    def sample(self, index):
+        self.wait_for(index + 1)
+        with self.__lock:
+            return self.__data[index - self.start]
+
+    def discard_upto(self, sample):
+        """
+        Forget about every sample before absolute index `sample`. The live
+        region is shifted down in place, so that the writer can keep on
+        appending without growing the buffer past what is still in use.
+        """
+        with self.__lock:
+            sample = min(sample, self.end)
+            if sample <= self.start:
+                return
+            live = self.end - sample
+            self.__data[0:live] = self.__data[sample - self.start:
+                                              self.end - self.start]
+            self.start = sample
+
+            #   Once nothing more is coming in, give back the memory that
+            #   the discarded head used to occupy.
+            if self.finished and live * 4 < len(self.__data):
+                self.__data = numpy.array(self.__data[0:live])
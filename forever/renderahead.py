@@ -0,0 +1,110 @@
+"""
+renderahead.py
+
+Renders an action's PCM in a background thread, well before the encoder
+gets to it. Transitions are by far the most expensive actions to render,
+but they're always preceded by a long, nearly free Playback - so we can
+get a head start on them while that plays.
+
+Once attached, a RenderAhead replaces the action's render method. The
+encoder consumes pre-rendered chunks; if it catches up to the background
+thread, it takes over and renders the rest inline.
+"""
+
+import logging
+import threading
+import traceback
+from collections import deque
+from audio import preserving
+from mixing import keep
+
+log = logging.getLogger(__name__)
+
+
+class RenderAhead(threading.Thread):
+    def __init__(self, action, chunk_size, limit):
+        """
+        Renders action in chunk_size chunks, holding at most `limit` samples
+        of rendered audio at a time.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.action = action
+        self.limit = limit
+
+        self.chunks = deque()
+        self.buffered = 0
+        self.done = False
+        self.taken = False
+        self.error = None
+
+        self.__gen = action.render(chunk_size)
+        self.__cond = threading.Condition()
+        self.__render_lock = threading.Lock()
+        action.render = self.render
+
+    def run(self):
+        try:
+            #   The encoder could still be reading earlier audio from the
+            #   same track, so we can't throw any of it away.
+            with preserving():
+                while True:
+                    with self.__cond:
+                        while self.buffered >= self.limit and not self.taken:
+                            self.__cond.wait()
+                    with self.__render_lock:
+                        if self.taken:
+                            return
+                        chunk = next(self.__gen, None)
+                        if chunk is None:
+                            return
+                        chunk = keep(chunk)
+                        with self.__cond:
+                            self.chunks.append(chunk)
+                            self.buffered += len(chunk)
+                            self.__cond.notify_all()
+        except Exception as e:
+            log.error("Could not render %s ahead of time:\n%s",
+                      self.action, traceback.format_exc())
+            self.error = e
+        finally:
+            with self.__cond:
+                self.done = True
+                self.__cond.notify_all()
+
+    def render(self, chunk_size=None):
+        """
+        Yields the action's PCM. Chunks are always the size that the
+        RenderAhead was created with, regardless of chunk_size.
+        """
+        while True:
+            with self.__cond:
+                if self.chunks:
+                    chunk = self.chunks.popleft()
+                    self.buffered -= len(chunk)
+                    self.__cond.notify_all()
+                elif self.done:
+                    chunk = None
+                else:
+                    log.info("Render-ahead of %s has fallen behind. "
+                             "Rendering the rest inline.", self.action)
+                    self.taken = True
+                    self.__cond.notify_all()
+                    chunk = None
+            if chunk is None:
+                break
+            yield chunk
+
+        if self.error is not None:
+            raise self.error
+
+        if self.taken:
+            #   Once we hold the render lock, the background thread is done
+            #   with the generator - but may have left a chunk behind.
+            with self.__render_lock:
+                leftover = list(self.chunks)
+                self.chunks.clear()
+            for chunk in leftover:
+                yield chunk
+            for chunk in self.__gen:
+                yield chunk
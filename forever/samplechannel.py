@@ -0,0 +1,93 @@
+"""
+samplechannel.py
+
+A queue between a producer of PCM and an encoder, bounded by how much audio
+it holds rather than by how many items. Occupancy counts every sample that
+has been put into the channel but hasn't yet come out of the far end of the
+encoder - queued items and whatever the encoder is still sitting on.
+
+Producers block in put() while the channel is at capacity, and are woken as
+soon as the encoder reports (through drained()) that enough has come out.
+An item bigger than the whole capacity is let in once the channel has
+drained down to `lag` samples - the most that the encoder holds on to
+without producing output - so that a long action can't block forever.
+"""
+
+import time
+import threading
+from collections import deque
+
+
+class SampleChannel(object):
+    def __init__(self, capacity, lag=0):
+        self.capacity = capacity
+        self.lag = lag
+        self.__items = deque()
+        self.__cond = threading.Condition()
+        self.__closed = False
+
+        #   Absolute sample counts since the channel was created.
+        self.total = 0          # samples put in, corrected with adjust()
+        self.consumed = 0       # samples the encoder has finished with
+        self.peak = 0           # the most that the channel has ever held
+        self.waited = 0.0       # seconds that producers have spent blocked
+
+    @property
+    def occupancy(self):
+        return self.total - self.consumed
+
+    def __len__(self):
+        return len(self.__items)
+
+    def put(self, item, samples, block=True):
+        """
+        Queue item, which holds `samples` samples of audio. Returns False
+        (and drops the item) if the channel is full and block is False,
+        or if the channel has been closed.
+        """
+        with self.__cond:
+            if self.__full(samples):
+                if not block:
+                    return False
+                start = time.time()
+                while self.__full(samples):
+                    self.__cond.wait()
+                self.waited += time.time() - start
+            if self.__closed:
+                return False
+            self.__items.append(item)
+            self.total += samples
+            self.peak = max(self.peak, self.occupancy)
+            self.__cond.notify_all()
+        return True
+
+    def __full(self, samples):
+        return not self.__closed and self.occupancy > self.lag and \
+            self.occupancy + samples > self.capacity
+
+    def get(self):
+        """The next item, blocking until there is one. None once closed."""
+        with self.__cond:
+            while not self.__items and not self.__closed:
+                self.__cond.wait()
+            if self.__items:
+                return self.__items.popleft()
+            return None
+
+    def adjust(self, samples):
+        """Correct the count when an item turned out to hold more or less."""
+        with self.__cond:
+            self.total += samples
+            self.__cond.notify_all()
+
+    def drained(self, consumed):
+        """The encoder is done with the first `consumed` samples put in."""
+        with self.__cond:
+            self.consumed = max(self.consumed, min(consumed, self.total))
+            self.__cond.notify_all()
+
+    def close(self):
+        """Let get() return None once empty, and stop blocking producers."""
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
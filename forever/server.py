@@ -270,10 +270,12 @@ if __name__ == "__main__":
              config.frontend_buffer)
     v2_queue = BufferedReadQueue(int(config.frontend_buffer / SECONDS_PER_FRAME))
     info_queue = multiprocessing.Queue()
+    memory_queue = multiprocessing.Queue()
 
     mixer = Mixer(iqueue=track_queue,
                   oqueues=(v2_queue.raw,),
-                  infoqueue=info_queue)
+                  infoqueue=info_queue,
+                  statsqueue=memory_queue)
     mixer.start()
 
     if stream:
@@ -284,6 +286,7 @@ if __name__ == "__main__":
             statistician, 'generate',
             lambda: StreamHandler.relays,
             InfoHandler.stats,
+            memory_queue=memory_queue,
             mp3_queue=v2_queue).start()
 
     tornado.ioloop.PeriodicCallback(
@@ -1,14 +1,28 @@
 import time
+import Queue
 import config
 from cube import emit
 
 
-def generate(get_relays, get_stats, **queues):
+def latest(queue, default):
+    """Drain a queue, returning the last item in it (or `default`)."""
+    try:
+        while True:
+            default = queue.get_nowait()
+    except Queue.Empty:
+        return default
+
+
+def generate(get_relays, get_stats, memory_queue=None, **queues):
+    memory = {}
     while True:
         time.sleep(config.monitor_update_time)
         relays = get_relays()
         emit("relays", {"count": len(relays)})
+        if memory_queue is not None:
+            memory = latest(memory_queue, memory)
         yield {"listeners": [dict(dict(g.request.headers).items() + [("remote_ip", g.request.remote_ip)])
                             for g in relays],
                "queues": dict([(n, q.buffered) for n, q in queues.iteritems()]),
+               "memory": memory,
                "info": get_stats()}
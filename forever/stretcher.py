@@ -0,0 +1,140 @@
+"""
+stretcher.py
+
+Time-stretches the beats of a Crossmatch across a pool of worker
+processes. Every beat is independent, so they can all be dispatched at
+once; results are handed back strictly in order, and each beat is
+stretched by exactly the same function as the serial path - so the
+output is bit-identical, just (a lot) faster on multi-core machines.
+
+Audio goes to and from the workers through memory-mapped files in
+/dev/shm (where available) rather than being pickled through pipes.
+"""
+
+import os
+import numpy
+import logging
+import tempfile
+import traceback
+import multiprocessing
+from action import stretch_beat
+
+log = logging.getLogger(__name__)
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+STRETCH_TIMEOUT = 30    # seconds to wait for any one beat
+SLACK = 1024            # extra output samples reserved per beat
+
+
+def shared_array(shape, dtype):
+    """A new memory-mapped array, and the path workers can open it from."""
+    fd, path = tempfile.mkstemp(prefix='stretch', dir=SHM_DIR)
+    os.close(fd)
+    return numpy.memmap(path, dtype=dtype, mode='w+', shape=shape), path
+
+
+class SharedFiles(object):
+    """
+    Deletes the files behind a set of shared arrays as soon as it's asked
+    to, or at the latest once nothing refers to it - i.e.: when a caller
+    drops the stretched beats without reading them all (or at all).
+    Arrays already mapped stay readable after their files are gone.
+    """
+    def __init__(self, *paths):
+        self.paths = list(paths)
+
+    def remove(self):
+        while self.paths:
+            try:
+                os.remove(self.paths.pop())
+            except OSError:
+                pass
+
+    def __del__(self):
+        self.remove()
+
+
+def stretch_shared(src, src_shape, start, end, rate, gain, quality,
+                   dst, dst_shape, offset, capacity):
+    """
+    Worker side: stretch src[start:end] and write it to dst at offset.
+    Returns the number of samples written or, if the result doesn't fit
+    in its slot, the stretched array itself.
+    """
+    beat = numpy.array(numpy.memmap(src, dtype=numpy.int16, mode='r',
+                                    shape=src_shape)[start:end])
+    out = stretch_beat(beat, rate, gain, quality)
+    if len(out) > capacity or out.dtype != numpy.float32:
+        return out
+    dst = numpy.memmap(dst, dtype=numpy.float32, mode='r+', shape=dst_shape)
+    dst[offset:offset + len(out)] = out
+    dst.flush()
+    return len(out)
+
+
+class ParallelStretcher(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.__pool = None
+        self.__pool_pid = None
+
+    @property
+    def pool(self):
+        #   Pools don't survive a fork, so make one per process.
+        if self.__pool is None or self.__pool_pid != os.getpid():
+            self.__pool = multiprocessing.Pool(self.workers)
+            self.__pool_pid = os.getpid()
+        return self.__pool
+
+    def stretch(self, t, plan, gain, quality=0):
+        """
+        Read every beat in plan from track t, dispatch them all to the pool
+        and return a generator over the stretched beats, in order.
+        """
+        first, last = plan[0][0], plan[-1][1]
+        region = t[first:last].data
+
+        src, src_path = shared_array(region.shape, numpy.int16)
+        files = SharedFiles(src_path)
+        src[:] = region
+        src.flush()
+
+        offsets, total = [], 0
+        for s, e, rate, length in plan:
+            offsets.append(total)
+            total += length + SLACK
+        dst, dst_path = shared_array((total,) + region.shape[1:],
+                                     numpy.float32)
+        files.paths.append(dst_path)
+
+        jobs = []
+        for (s, e, rate, length), offset in zip(plan, offsets):
+            args = (src_path, region.shape, s - first, e - first, rate, gain,
+                    quality, dst_path, dst.shape, offset, length + SLACK)
+            try:
+                jobs.append(self.pool.apply_async(stretch_shared, args))
+            except Exception:
+                log.error("Could not dispatch beat:\n%s",
+                          traceback.format_exc())
+                jobs.append(None)
+        return self.__collect(region, plan, first, gain, quality, jobs,
+                              offsets, dst, files)
+
+    def __collect(self, region, plan, first, gain, quality, jobs, offsets,
+                  dst, files):
+        try:
+            for (s, e, rate, _), job, offset in zip(plan, jobs, offsets):
+                try:
+                    result = job.get(STRETCH_TIMEOUT)
+                except Exception:
+                    if job is not None:
+                        log.error("Stretching failed in pool, retrying:\n%s",
+                                  traceback.format_exc())
+                    result = stretch_beat(region[s - first:e - first],
+                                          rate, gain, quality)
+                if isinstance(result, numpy.ndarray):
+                    yield result
+                else:
+                    yield dst[offset:offset + result]
+        finally:
+            files.remove()